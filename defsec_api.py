@@ -4,36 +4,152 @@
 # @Author: Gaelin Shupe
 # @Created: 9/19/23
 import asyncio
+import dataclasses
+import functools
+import logging
+from typing import Any, Awaitable, Callable
 
-import requests
+import aiohttp
 
-from util import get_vapp_url_from_id
+from metrics import API_LATENCY, ERRORS
+from outbound import OutboundPolicy
+from util import TTLCache, get_vapp_url_from_id
+
+logger = logging.getLogger("authbot")
+
+
+def coalesced(method):
+    """Share one in-flight call (and its result for a short time) between identical concurrent calls"""
+
+    @functools.wraps(method)
+    async def wrapper(self: "DefSecApi", *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        return await self._coalesce(key, lambda: method(self, *args, **kwargs))
+
+    return wrapper
 
 
 class DefSecApi:
-    def __init__(self, host: str, api_key: str):
+    # Seconds allowed per endpoint, anything not listed gets the full timeout
+    TIMEOUTS = {
+        "is_valid_user": 10,
+        "check_status": 10,
+        "get_templates": 10,
+        "get_catalogs": 10,
+        "get_all_vapps_for_owner": 10,
+    }
+
+    def __init__(
+        self,
+        host: str,
+        api_key: str,
+        *,
+        connection_limit: int = 20,
+        timeout: float = 30,
+        coalesce_ttl: float = 5,
+        vapp_list_ttl: float = 60,
+        timeouts: dict[str, float] = None,
+    ):
         self.api_key = api_key
         self.host = host
         self.headers = {"Content-Type": "application/json", "X-Api-Key": self.api_key}
+        self.connection_limit = connection_limit
+        self._session: aiohttp.ClientSession | None = None
+        self.policy = OutboundPolicy("IALab", timeouts={**self.TIMEOUTS, **(timeouts or {})}, default_timeout=timeout)
+        self._in_flight: dict[tuple, asyncio.Task] = {}
+        self._results = TTLCache(maxsize=1024, ttl=coalesce_ttl)
+        self.coalesce_stats = {"calls": 0, "deduplicated": 0}
+        self.poller = DeployPoller(self)
+        self._owner_vapps = TTLCache(maxsize=512, ttl=vapp_list_ttl)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Shared keep-alive session, created on first use inside the event loop"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=self.connection_limit),
+                # Per endpoint timeouts are enforced by the outbound policy
+                timeout=aiohttp.ClientTimeout(total=None),
+            )
+        return self._session
+
+    async def close(self) -> None:
+        """Close the shared session"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
+    async def _request(self, method: str, path: str, *, endpoint: str, json: Any = None) -> tuple[int, Any]:
+        """
+        Make a request to the api under the outbound policy. Only GET requests are retried
+        :return: Status code and decoded json body (None if the body is not json)
+        :raises DependencyUnavailable: If the api is failing
+        """
+
+        async def request() -> tuple[int, Any]:
+            async with self.session.request(method, f"{self.host}{path}", json=json) as resp:
+                try:
+                    data = await resp.json(content_type=None)
+                except ValueError:
+                    data = None
+                return resp.status, data
+
+        try:
+            with API_LATENCY.time(endpoint=endpoint):
+                return await self.policy.call(
+                    endpoint, request, idempotent=method == "GET", failed=lambda response: response[0] >= 500
+                )
+        except Exception:
+            ERRORS.inc(source="ialab")
+            raise
+
+    async def _coalesce(self, key: tuple, call: Callable[[], Awaitable]) -> Any:
+        """Run call unless an identical call is already running or finished within coalesce_ttl"""
+        self.coalesce_stats["calls"] += 1
+        if (result := self._results.get(key)) is not None:
+            self.coalesce_stats["deduplicated"] += 1
+            return result[0]
+        if (task := self._in_flight.get(key)) is not None:
+            self.coalesce_stats["deduplicated"] += 1
+        else:
+            task = asyncio.ensure_future(call())
+            self._in_flight[key] = task
+            task.add_done_callback(functools.partial(self._call_done, key))
+        # Shield so one cancelled caller does not cancel the call for everybody else
+        return await asyncio.shield(task)
+
+    def _call_done(self, key: tuple, task: asyncio.Task) -> None:
+        self._in_flight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self._results.set(key, (task.result(),))
+
+    @coalesced
     async def is_valid_user(self, user: str):
         if user is None:
             return False
-        resp = requests.get(
-            f"{self.host}/user/{user}",
-            headers=self.headers,
-        )
-        if resp.status_code == 200:
-            return resp.json()["valid"]
+        status, data = await self._request("GET", f"/user/{user}", endpoint="is_valid_user")
+        if status == 200:
+            return data["valid"]
         return False
 
     async def get_template_id(self, template_name: str, catalog: str = None) -> str | None:
         return (await self.get_templates(template_name, catalog=catalog)).get(template_name, None)
 
     async def deploy_lesson(self, username: str, template_name: str = "", template_id: str = "") -> str:
-        resp = requests.post(
-            f"{self.host}/deploy",
-            headers=self.headers,
+        return (await self.deploy_lessons([username], template_name=template_name, template_id=template_id))[username]
+
+    async def deploy_lessons(
+        self, usernames: list[str], template_name: str = "", template_id: str = ""
+    ) -> dict[str, str | None]:
+        """
+        Deploy a template to many users with one multi-variant deploy
+        :return: Dict of username to vApp url, or None for deploys that did not start or finish
+        """
+        status, data = await self._request(
+            "POST",
+            "/deploy",
+            endpoint="deploy",
             json={
                 "template": template_name,
                 "catalog": "",
@@ -43,21 +159,36 @@ class DefSecApi:
                 "no_cache": False,
                 "deploy_lease_seconds": 7200,
                 "storage_lease_seconds": 432000,
-                "variants": [username],
+                "variants": usernames,
                 "force_synchronous": False,  # no bad :/
                 "make_owner": True,
             },
         )
-        action_id = list(resp.json()["status"].values())[0]
-        for _ in range(200):
-            await asyncio.sleep(5)
-            if (vapp_id := await self.check_status(action_id)) is not None:
-                return get_vapp_url_from_id(vapp_id)
+        urls: dict[str, str | None] = {username: None for username in usernames}
+        if not isinstance(data, dict) or not isinstance(data.get("status"), dict):
+            logger.warning(f"Deploy of {template_id or template_name} to {len(usernames)} users failed: {status}")
+            return urls
+        action_ids = data["status"]
+        if not action_ids.keys() & set(usernames):
+            # Actions are returned in variant order
+            action_ids = dict(zip(usernames, action_ids.values()))
+        started = [username for username in usernames if username in action_ids]
+        if len(started) < len(usernames):
+            logger.warning(f"No deploy action for {set(usernames) - set(started)} of {template_id or template_name}")
+        vapp_ids = await asyncio.gather(
+            *(self.poller.wait(action_ids[username], template_id or template_name) for username in started)
+        )
+        self.invalidate_vapps(*started)
+        for username, vapp_id in zip(started, vapp_ids):
+            if vapp_id is not None:
+                urls[username] = get_vapp_url_from_id(vapp_id)
+        return urls
 
     async def deploy_team(self, team_name: str, users: list[str], template_id: str = "") -> str:
-        resp = requests.post(
-            f"{self.host}/deploy",
-            headers=self.headers,
+        status, data = await self._request(
+            "POST",
+            "/deploy",
+            endpoint="deploy",
             json={
                 "template": "",
                 "catalog": "DefSec_Lessons",
@@ -72,55 +203,273 @@ class DefSecApi:
                 "make_owner": False,
             },
         )
-        action_id = list(resp.json()["status"].values())[0]
-        for _ in range(200):
-            await asyncio.sleep(5)
-            if (vapp_id := await self.check_status(action_id)) is not None:
-                await self.set_access(vapp_id, owner=None, users=users)
-                return f"https://vcloud.ialab.dsu.edu/tenant/DefSec/vdcs/1b507d5f-2faf-4d90-b7c2-27ef48d9ff88/vapp/vapp-{vapp_id}/vcd-vapp-vms"
+        action_id = list(data["status"].values())[0]
+        if (vapp_id := await self.poller.wait(action_id, template_id)) is not None:
+            await self.set_access(vapp_id, owner=None, users=users)
+            return f"https://vcloud.ialab.dsu.edu/tenant/DefSec/vdcs/1b507d5f-2faf-4d90-b7c2-27ef48d9ff88/vapp/vapp-{vapp_id}/vcd-vapp-vms"
+
+    async def deploy_spare(self, template_id: str, variant: str) -> str | None:
+        """
+        Deploy a lesson vApp without an owner so it can be handed out later
+        :return: vApp ID or None if the deploy did not finish
+        """
+        status, data = await self._request(
+            "POST",
+            "/deploy",
+            endpoint="deploy",
+            json={
+                "template": "",
+                "catalog": "",
+                "template_id": template_id,
+                "start": False,
+                "snapshot": False,
+                "no_cache": False,
+                "deploy_lease_seconds": 7200,
+                "storage_lease_seconds": 432000,
+                "variants": [variant],
+                "force_synchronous": False,  # no bad :/
+                "make_owner": False,
+            },
+        )
+        action_id = list(data["status"].values())[0]
+        return await self.poller.wait(action_id, template_id)
 
     async def set_access(self, vapp_id: str, owner: str, users: list[str]) -> bool:
-        resp = requests.post(
-            f"{self.host}/access/{vapp_id}",
-            headers=self.headers,
-            data={"owner": owner, "perms": {user: "Read" for user in users}},
+        status, data = await self._request(
+            "POST",
+            f"/access/{vapp_id}",
+            endpoint="set_access",
+            json={"owner": owner, "perms": {user: "Read" for user in users}},
         )
-        return resp.json()["success"]
+        self.invalidate_vapps(*users, *([owner] if owner is not None else []))
+        return data["success"]
 
     async def check_status(self, action_id: str):
-        resp = requests.get(
-            f"{self.host}/deploy_action/{action_id}",
-            headers=self.headers,
-        )
-        return resp.json()["id"] if resp.status_code == 200 else None
+        status, data = await self._request("GET", f"/deploy_action/{action_id}", endpoint="check_status")
+        return data["id"] if status == 200 else None
 
     async def get_lessons(self, partial: str) -> dict:
-        return await self.get_templates(partial, "DefSec_Lessons")
+        return await self.get_templates(partial, TemplateIndex.LESSONS)
 
+    @coalesced
     async def get_templates(self, partial: str, catalog: str = None) -> dict:
         if catalog is not None:
-            url = f"{self.host}/catalog/{catalog}/templates/{partial}"
+            path = f"/catalog/{catalog}/templates/{partial}"
         else:
-            url = f"{self.host}/templates/{partial}"
-        resp = requests.get(url, headers=self.headers)
-        return resp.json()["templates"] if resp.status_code == 200 else {}
+            path = f"/templates/{partial}"
+        status, data = await self._request("GET", path, endpoint="get_templates")
+        return data["templates"] if status == 200 else {}
 
+    @coalesced
     async def get_catalogs(self, catalog: str) -> list[str]:
-        resp = requests.get(
-            f"{self.host}/catalogs/{catalog}",
-            headers=self.headers,
-        )
-        return resp.json()["catalogs"] if resp.status_code == 200 else []
+        status, data = await self._request("GET", f"/catalogs/{catalog}", endpoint="get_catalogs")
+        return data["catalogs"] if status == 200 else []
 
     async def get_vapps_for_owner(self, vapp_partial: str, owner: str) -> dict[str, str]:
-        resp = requests.get(
-            f"{self.host}/user/{owner}/vapps/{vapp_partial}",
-            headers=self.headers,
-        )
-        return resp.json() if resp.status_code == 200 else {}
+        """Get the owner's vApps starting with vapp_partial from a short lived copy of their vApp list"""
+        if (vapps := self._owner_vapps.get(owner)) is None:
+            vapps = await self.get_all_vapps_for_owner(owner)
+            if vapps:
+                self._owner_vapps.set(owner, vapps)
+        vapp_partial = vapp_partial.lower()
+        return {name: vapp_id for name, vapp_id in vapps.items() if name.lower().startswith(vapp_partial)}
+
+    @coalesced
+    async def get_all_vapps_for_owner(self, owner: str) -> dict[str, str]:
+        status, data = await self._request("GET", f"/user/{owner}/vapps/", endpoint="get_all_vapps_for_owner")
+        return data if status == 200 else {}
+
+    def invalidate_vapps(self, *owners: str) -> None:
+        """Forget the cached vApp lists of owners whose vApps changed"""
+        for owner in owners:
+            self._owner_vapps.invalidate(owner)
+            self._results.invalidate(("get_all_vapps_for_owner", (owner,), ()))
 
     async def share_vapp(self, vapp_id: str, users: list[str], level="FullControl") -> bool:
-        resp = requests.post(
-            f"{self.host}/vapp/{vapp_id}/access", headers=self.headers, json={"level": level, "users": users}
+        status, data = await self._request(
+            "POST", f"/vapp/{vapp_id}/access", endpoint="share_vapp", json={"level": level, "users": users}
+        )
+        self.invalidate_vapps(*users)
+        return status == 200
+
+
+@dataclasses.dataclass
+class _DeployAction:
+    """A deploy action being polled"""
+
+    action_id: str
+    template: str
+    future: asyncio.Future
+    started: float
+    next_check: float
+    interval: float
+
+
+class DeployPoller:
+    """
+    Single poller for every in-flight deploy action.
+    Actions are first checked around when deploys of the same template usually finish and
+    then with an exponential backoff, instead of every 5 seconds each.
+    """
+
+    def __init__(
+        self,
+        api: DefSecApi,
+        *,
+        min_interval: float = 5,
+        max_interval: float = 60,
+        max_wait: float = 1000,
+        concurrency: int = 10,
+    ):
+        self.api = api
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_wait = max_wait
+        self.concurrency = concurrency
+        self.durations: dict[str, float] = {}
+        self._actions: dict[str, _DeployAction] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def in_flight(self) -> int:
+        """Number of actions being polled"""
+        return len(self._actions)
+
+    async def wait(self, action_id: str, template: str = "") -> str | None:
+        """
+        Wait for a deploy action to finish
+        :param action_id: Action returned by /deploy
+        :param template: Template being deployed, used to learn deploy durations
+        :return: vApp ID or None if the deploy did not finish within max_wait
+        """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        expected = self.durations.get(template, 0) * 0.9
+        action = _DeployAction(
+            action_id=action_id,
+            template=template,
+            future=loop.create_future(),
+            started=now,
+            next_check=now + max(self.min_interval, expected),
+            interval=self.min_interval,
         )
-        return resp.status_code == 200
+        self._actions[action_id] = action
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        try:
+            return await action.future
+        finally:
+            self._actions.pop(action_id, None)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._actions:
+            self._wakeup.clear()
+            now = loop.time()
+            due = [action for action in self._actions.values() if action.next_check <= now]
+            if not due:
+                next_check = min(action.next_check for action in self._actions.values())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=next_check - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for start in range(0, len(due), self.concurrency):
+                await asyncio.gather(*(self._check(action) for action in due[start : start + self.concurrency]))
+
+    async def _check(self, action: _DeployAction) -> None:
+        if action.future.done():
+            return
+        try:
+            vapp_id = await self.api.check_status(action.action_id)
+        except Exception as e:
+            # Treated as not finished so one bad response cannot stop polling of every other action
+            logger.warning(f"Could not check deploy {action.action_id}: {e!r}")
+            vapp_id = None
+        now = asyncio.get_running_loop().time()
+        elapsed = now - action.started
+        if vapp_id is not None:
+            previous = self.durations.get(action.template, elapsed)
+            self.durations[action.template] = previous * 0.7 + elapsed * 0.3
+            action.future.set_result(vapp_id)
+        elif elapsed >= self.max_wait:
+            logger.warning(f"Gave up on deploy {action.action_id} after {elapsed:.0f}s")
+            action.future.set_result(None)
+        else:
+            action.next_check = now + action.interval
+            action.interval = min(action.interval * 1.5, self.max_interval)
+
+
+class TemplateIndex:
+    """Periodically refreshed local copy of the template catalogs used for autocomplete and lookups"""
+
+    LESSONS = "DefSec_Lessons"
+
+    def __init__(self, api: DefSecApi, catalogs: list[str | None], refresh_interval: float = 300):
+        self.api = api
+        self.catalogs = catalogs
+        self.refresh_interval = refresh_interval
+        self._templates: dict[str | None, dict[str, str]] = {}
+
+    async def refresh(self) -> None:
+        """Reload every catalog, keeping the previous copy of any catalog that fails to load"""
+        for catalog in self.catalogs:
+            try:
+                templates = await self.api.get_templates("", catalog=catalog)
+            except Exception as e:
+                # Includes malformed responses, which must not end the refresh task
+                logger.warning(f"Could not refresh templates for {catalog or 'all catalogs'}: {e!r}")
+                continue
+            if templates or catalog not in self._templates:
+                self._templates[catalog] = templates
+
+    async def run(self) -> None:
+        """Refresh the index forever. Infinitely blocking"""
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.refresh_interval)
+
+    def loaded(self, catalog: str = None) -> bool:
+        """Whether a catalog has been loaded at least once"""
+        return catalog in self._templates
+
+    async def get_template_id(self, template_name: str, catalog: str = None) -> str | None:
+        """Resolve a template name, only asking the api if the catalog has not loaded yet"""
+        if not self.loaded(catalog):
+            return await self.api.get_template_id(template_name, catalog=catalog)
+        return self._templates[catalog].get(template_name, None)
+
+    def search(self, partial: str, catalog: str = None, limit: int = 25) -> list[str]:
+        """
+        Find template names matching a partial name
+        Exact matches rank first, then prefix, word prefix, substring and finally fuzzy (in order) matches
+        :return: Up to limit template names, best match first
+        """
+        partial = partial.lower()
+        ranked = []
+        for name in self._templates.get(catalog, {}):
+            if (rank := self._rank(name.lower(), partial)) is not None:
+                ranked.append((rank, len(name), name))
+        ranked.sort()
+        return [name for _, _, name in ranked[:limit]]
+
+    @staticmethod
+    def _rank(name: str, partial: str) -> int | None:
+        if name == partial:
+            return 0
+        if name.startswith(partial):
+            return 1
+        position = name.find(partial)
+        if position > 0:
+            # Any occurrence at the start of a word makes it a word prefix match
+            while position != -1:
+                if not name[position - 1].isalnum():
+                    return 2
+                position = name.find(partial, position + 1)
+            return 3
+        remaining = iter(name)
+        if all(char in remaining for char in partial):
+            return 4
+        return None
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# @Name: deploy.py
+# @Project: DSUAuthBot/
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import logging
+import secrets
+import time
+from typing import Awaitable, Callable
+
+from defsec_api import DefSecApi
+from util import DBC, get_vapp_url_from_id
+
+logger = logging.getLogger("authbot")
+
+
+class DeployBatcher:
+    """Collects deploys of the same template for a short window and sends them as one multi-variant deploy"""
+
+    def __init__(
+        self,
+        deploy_many: Callable[[list[str], str], Awaitable[dict[str, str | None]]],
+        *,
+        window: float = 1,
+        max_batch: int = 20,
+        concurrency: int = 5,
+    ):
+        """
+        :param deploy_many: Coroutine function deploying a template id to a list of usernames
+        :param window: Seconds to wait for more deploys of a template before sending the batch
+        :param max_batch: Batches are sent early once they reach this many users
+        :param concurrency: Maximum batches being deployed at once
+        """
+        self.deploy_many = deploy_many
+        self.window = window
+        self.max_batch = max_batch
+        self.concurrency = concurrency
+        self._slots = asyncio.Semaphore(concurrency)
+        self.stats = {"deploys": 0, "batches": 0}
+        self._pending: dict[str, dict[str, list[asyncio.Future]]] = {}
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+
+    async def deploy(self, username: str, template_id: str) -> str | None:
+        """
+        Deploy a template to a user as part of the next batch
+        :return: vApp url or None if the deploy failed
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(template_id, {})
+        batch.setdefault(username, []).append(future)
+        self.stats["deploys"] += 1
+        if len(batch) >= self.max_batch:
+            self._flush(template_id)
+        elif template_id not in self._timers:
+            self._timers[template_id] = loop.call_later(self.window, self._flush, template_id)
+        return await future
+
+    def _flush(self, template_id: str) -> None:
+        if (timer := self._timers.pop(template_id, None)) is not None:
+            timer.cancel()
+        if batch := self._pending.pop(template_id, None):
+            self.stats["batches"] += 1
+            asyncio.create_task(self._send(template_id, batch))
+
+    async def _send(self, template_id: str, batch: dict[str, list[asyncio.Future]]) -> None:
+        try:
+            async with self._slots:
+                urls = await self.deploy_many(list(batch), template_id)
+        except Exception as e:
+            logger.warning(f"Batch deploy of {template_id} to {len(batch)} users failed: {e}")
+            urls = {}
+        for username, futures in batch.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(urls.get(username))
+
+
+class DeployInProgress(Exception):
+    """The user already has a deploy of this template queued or running"""
+
+
+@dataclasses.dataclass
+class _QueuedDeploy:
+    """A deploy waiting for a free slot"""
+
+    granted: asyncio.Future
+    on_position: Callable[[int], Awaitable[None]] | None
+    position: int = 0
+
+
+class DeployScheduler:
+    """
+    FIFO deploy queue in front of the api.
+    At most concurrency deploys run at once and each user may only have one deploy of a template queued or running.
+    """
+
+    def __init__(
+        self,
+        deploy: Callable[[str, str], Awaitable[str | None]],
+        *,
+        concurrency: int = 5,
+        notify_below: int = 5,
+    ):
+        """
+        :param deploy: Coroutine function deploying a template id to a username
+        :param concurrency: Maximum deploys running at once
+        :param notify_below: Waiters are told each time their position changes once they are this close to the front
+        """
+        self.deploy = deploy
+        self.concurrency = concurrency
+        self.notify_below = notify_below
+        self.running = 0
+        self._active: set[tuple[str, str]] = set()
+        self._queue: collections.deque[_QueuedDeploy] = collections.deque()
+
+    @property
+    def queued(self) -> int:
+        """Number of deploys waiting for a slot"""
+        return len(self._queue)
+
+    def is_active(self, username: str, template_id: str) -> bool:
+        """Whether the user already has this template queued or deploying"""
+        return (username, template_id) in self._active
+
+    async def submit(
+        self, username: str, template_id: str, on_position: Callable[[int], Awaitable[None]] = None
+    ) -> str | None:
+        """
+        Queue a deploy and wait for it to finish
+        :param username: IALab username to deploy to
+        :param template_id: Template to deploy
+        :param on_position: Called with the queue position while waiting
+        :return: vApp url or None if the deploy failed
+        :raises DeployInProgress: If the user already has this template queued or deploying
+        """
+        with self.reserve(username, template_id):
+            await self._acquire(on_position)
+            try:
+                return await self.deploy(username, template_id)
+            finally:
+                self._release()
+
+    @contextlib.contextmanager
+    def reserve(self, username: str, template_id: str):
+        """
+        Mark the user as having this template active for the block, e.g. while handing out a warm spare
+        :raises DeployInProgress: If the user already has this template queued or deploying
+        """
+        if self.is_active(username, template_id):
+            raise DeployInProgress(template_id)
+        self._active.add((username, template_id))
+        try:
+            yield
+        finally:
+            self._active.discard((username, template_id))
+
+    async def _acquire(self, on_position: Callable[[int], Awaitable[None]] | None) -> None:
+        if self.running < self.concurrency and not self._queue:
+            self.running += 1
+            return
+        waiter = _QueuedDeploy(asyncio.get_running_loop().create_future(), on_position)
+        self._queue.append(waiter)
+        self._notify(waiter, len(self._queue))
+        try:
+            await waiter.granted
+        except asyncio.CancelledError:
+            if waiter.granted.done() and not waiter.granted.cancelled():
+                # The slot was handed over just before the cancel
+                self._release()
+            elif waiter in self._queue:
+                # _release may already have dropped the cancelled waiter
+                self._queue.remove(waiter)
+                self._notify_all()
+            raise
+
+    def _release(self) -> None:
+        self.running -= 1
+        while self._queue and self.running < self.concurrency:
+            waiter = self._queue.popleft()
+            if not waiter.granted.done():
+                self.running += 1
+                waiter.granted.set_result(None)
+        self._notify_all()
+
+    def _notify_all(self) -> None:
+        for position, waiter in enumerate(self._queue, start=1):
+            if position <= self.notify_below:
+                self._notify(waiter, position)
+
+    @staticmethod
+    def _notify(waiter: _QueuedDeploy, position: int) -> None:
+        if waiter.on_position is not None and waiter.position != position:
+            waiter.position = position
+            asyncio.create_task(_log_errors(waiter.on_position(position)))
+
+
+async def _log_errors(coro: Awaitable) -> None:
+    """Await a background notification, logging instead of raising failures"""
+    try:
+        await coro
+    except Exception as e:
+        logger.warning(f"Could not send deploy update: {e}")
+
+
+class WarmPool:
+    """Keeps unowned, pre-deployed vApps of popular templates ready to hand out on click"""
+
+    def __init__(self, api: DefSecApi, dbc: DBC, sizes: dict[str, int], *, max_age: float = 345600):
+        """
+        :param sizes: Number of spare vApps to keep for each template id
+        :param max_age: Seconds before a spare is discarded, must be below the storage lease
+        """
+        self.api = api
+        self.dbc = dbc
+        self.sizes = sizes
+        self.max_age = max_age
+        self.stats = {"hits": 0, "misses": 0}
+        self._ready: dict[str, collections.deque[tuple[str, float]]] = {
+            template_id: collections.deque() for template_id in sizes
+        }
+        self._deploying: dict[str, int] = {template_id: 0 for template_id in sizes}
+
+    async def start(self) -> None:
+        """Load spares that survived a restart and top up every pool"""
+        for vapp_id, template_id, created in await self.dbc.get_warm_vapps():
+            if template_id in self._ready:
+                self._ready[template_id].append((vapp_id, created))
+        for template_id in self.sizes:
+            self._refill(template_id)
+
+    async def claim(self, username: str, template_id: str) -> str | None:
+        """
+        Hand a spare vApp to a user. Failures are logged and treated as no spare being available
+        :return: vApp url or None if no spare is available
+        """
+        if template_id not in self._ready:
+            return None
+        ready = self._ready[template_id]
+        try:
+            while ready:
+                vapp_id, created = ready.popleft()
+                if not await self.dbc.remove_warm_vapp(vapp_id):
+                    continue
+                if time.time() - created > self.max_age:
+                    logger.info(f"Discarded stale spare {vapp_id} of {template_id}")
+                    continue
+                try:
+                    handed = await self.api.set_access(vapp_id, owner=username, users=[])
+                except Exception as e:
+                    # The api is likely failing so put the spare back and let the deploy queue handle it
+                    logger.warning(f"Could not hand spare {vapp_id} to {username}: {e!r}")
+                    await self.dbc.add_warm_vapp(vapp_id, template_id)
+                    ready.appendleft((vapp_id, created))
+                    break
+                if handed:
+                    self.stats["hits"] += 1
+                    return get_vapp_url_from_id(vapp_id)
+                logger.warning(f"Could not hand spare {vapp_id} to {username}")
+        except Exception as e:
+            logger.warning(f"Could not claim a spare of {template_id}: {e!r}")
+        finally:
+            self._refill(template_id)
+        self.stats["misses"] += 1
+        return None
+
+    def _refill(self, template_id: str) -> None:
+        missing = self.sizes[template_id] - len(self._ready[template_id]) - self._deploying[template_id]
+        for _ in range(max(missing, 0)):
+            self._deploying[template_id] += 1
+            asyncio.create_task(self._deploy_spare(template_id))
+
+    async def _deploy_spare(self, template_id: str) -> None:
+        try:
+            vapp_id = await self.api.deploy_spare(template_id, f"spare-{secrets.token_hex(4)}")
+            if vapp_id is None:
+                logger.warning(f"Spare deploy of {template_id} did not finish")
+                return
+            await self.dbc.add_warm_vapp(vapp_id, template_id)
+            self._ready[template_id].append((vapp_id, time.time()))
+        except Exception as e:
+            logger.warning(f"Could not deploy spare of {template_id}: {e}")
+        finally:
+            self._deploying[template_id] -= 1
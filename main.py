@@ -1,108 +1,47 @@
 #!/usr/bin/python
 import asyncio
-import base64
 import json
 import logging
+import multiprocessing
 from datetime import datetime
-from re import compile as re_compile
 
 import discord
 
-from defsec_api import DefSecApi
-from util import AzureOauth, DBC, Config, get_position, UrlButton, BasicTextInput, get_vapp_url_from_id
+from defsec_api import DefSecApi, TemplateIndex
+from deploy import DeployBatcher, DeployInProgress, DeployScheduler, WarmPool
+from metrics import COMMAND_LATENCY, DEPLOYS, ERRORS, Gauge
+from outbound import CircuitBreaker, DependencyUnavailable
+from util import (
+    AzureOauth,
+    DBC,
+    Config,
+    UrlButton,
+    BasicTextInput,
+    get_vapp_url_from_id,
+    ProgressEmbed,
+    redeem_oauth,
+    Verification,
+)
+from webserver import AdmissionController, RedirectReceiver, run_worker, start_metrics_server, start_webserver
 
 logging.basicConfig(filename="run.log")
 logger = logging.getLogger("authbot")
 logger.setLevel(logging.INFO)
 
 
-async def start_webserver(server) -> None:
-    """Start serving the webserver. Infinitely blocking"""
-    async with server:
-        await server.serve_forever()
-
-
-class RedirectReceiver(asyncio.Protocol):
-    """Very simple webserver to receive oauth"""
-
-    # noinspection RegExpAnonymousGroup
-    REQUEST_LINE_RE = re_compile(r"^GET /.*\?code=([a-zA-Z0-9._-]+)&state=([a-zA-Z0-9]{16}).+ HTTP/\d.\d$")
-
-    # noinspection PyMissingOrEmptyDocstring,PyAttributeOutsideInit
-    def connection_made(self, transport) -> None:
-        """Honesty, I have no clue but it doesnt work without this function"""
-        self.transport = transport
-
-    def data_received(self, data) -> None:
-        """Data received on the socket"""
-        asyncio.create_task(self.async_data_received(data))
-
-    async def async_data_received(self, data) -> None:
-        """Async data processing so that calls can be made to the bot"""
-        request = data.decode(errors="ignore")
-        headers = request.split("\r\n")
-        matches = RedirectReceiver.REQUEST_LINE_RE.fullmatch(headers[0])
-        if matches is None:
-            self.send_response("Invalid request<br>Pls no hak me 😢", "400 no 👎")
-            return
-
-        authorization_code = matches[1]
-        state = matches[2]
-        logger.info(f"Auth: {state=} {authorization_code[:10]}")
-        try:
-            self.send_response(await bot.verify_member(state, authorization_code))
-        except Exception as e:
-            logger.warning(f"Uncaught exception: {e} in verify")
-            self.send_response("Invalid request 😢", "500 Oopsy Woopsy")
-
-    def send_response(self, message, status_code="200 OK"):
-        """Send an HTML formatted response"""
-        full_message = (
-            """<!DOCTYPE html>
-            <html lang="en">
-            <head>
-                <title>DSU Verification</title>
-                <style>
-                    body {
-                        background: #004165;
-                    }
-            
-                    .center {
-                        position: absolute;
-                        left: 50%;
-                        top: 30%;
-                        transform: translate(-50%, -50%);
-                        text-align: center;
-                        color: #ffffff;
-                    }
-            
-                    .center > * {
-                        margin: 0;
-                    }
-            
-                    #main {
-                        background: #ADAFAF;
-                        border-radius: 10px;
-                        padding: 15px;
-                    }
-                </style>
-            </head>
-            <body>
-            <div class="center" id="main"><h1>"""
-            + f"{message}"
-            + """</h1></div></body></html>"""
-        )
-        http_response = f"HTTP/1.1 {status_code}\r\n"
-        http_response += "Server: DefSecAuthBot/2.0 Python/3\r\n"
-        http_response += "Content-Type: text/html; charset=utf-8\r\n"
-        http_response += "Root-Password: Password1!\r\n"
-        http_response += f"Content-Length: {len(full_message)}\r\n"
-        http_response += "\r\n"
-        http_response += full_message
-
+async def send_error(interaction: discord.Interaction, error: Exception) -> None:
+    """Tell the user about a failed dependency, otherwise log the error"""
+    if not isinstance(error, DependencyUnavailable):
+        logger.error(f"Ignoring exception in interaction {interaction.id}", exc_info=error)
+        return
+    if interaction.type == discord.InteractionType.autocomplete:
+        return
+    # noinspection PyUnresolvedReferences
+    if interaction.response.is_done():
+        await interaction.followup.send(content=error.message, ephemeral=True)
+    else:
         # noinspection PyUnresolvedReferences
-        self.transport.write(http_response.encode("UTF-8"))
-        self.transport.close()
+        await interaction.response.send_message(content=error.message, ephemeral=True)
 
 
 class HelpForm(discord.ui.Modal):
@@ -137,6 +76,9 @@ class DeployButtonView(discord.ui.View):
         super().__init__(timeout=None)
         self.add_item(DeployButton(template_id, template_name))
 
+    async def on_error(self, interaction: discord.Interaction, error: Exception, item: discord.ui.Item) -> None:
+        await send_error(interaction, error)
+
 
 class DeployButton(
     discord.ui.Button  # discord.ui.dynamic.DynamicItem[discord.ui.Button],
@@ -168,6 +110,10 @@ class DeployButton(
             )
             return
 
+        if user.ialab_username is not None and user.ialab_validated_within(bot.ialab_revalidate):
+            await self.deploy_it(interaction, user.ialab_username)
+            return
+
         if user.ialab_username is None:
             username = user.email.split("@")[0].lower()
             if await defsecapi.is_valid_user(username):
@@ -189,6 +135,7 @@ class DeployButton(
                 )
             )
         else:
+            await bot.dbc.mark_ialab_validated(interaction.user.id)
             await self.deploy_it(interaction, user.ialab_username)
 
     async def update_user(self, interaction: discord.Interaction, username: str):
@@ -212,64 +159,120 @@ class DeployButton(
         asyncio.create_task(self.update_embed(interaction))
         # noinspection PyUnresolvedReferences
         await interaction.response.defer(ephemeral=True, thinking=True)
-        vapp_url = await defsecapi.deploy_lesson(username, template_id=self.template_id)
+
+        async def on_position(position: int):
+            await interaction.edit_original_response(content=f"You are #{position} in line for a vapp ⏳")
+
+        try:
+            with deploy_scheduler.reserve(username, self.template_id):
+                vapp_url = await warm_pool.claim(username, self.template_id)
+            result = "warm"
+            if vapp_url is None:
+                vapp_url = await deploy_scheduler.submit(username, self.template_id, on_position=on_position)
+                result = "deployed"
+        except DeployInProgress:
+            DEPLOYS.inc(result="duplicate")
+            await interaction.followup.send(content="Your vapp is already being deployed!", ephemeral=True)
+            return
+        if vapp_url is None:
+            DEPLOYS.inc(result="failed")
+            await interaction.followup.send(content="Your vapp could not be deployed 😢", ephemeral=True)
+            return
+        DEPLOYS.inc(result=result)
         await interaction.followup.send(view=UrlButton(label="Your vapp is ready", url=vapp_url), ephemeral=True)
 
 
+def observe_command(interaction: discord.Interaction, command) -> None:
+    """Record how long a slash command took since the interaction was created"""
+    elapsed = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+    COMMAND_LATENCY.observe(elapsed, command=command.qualified_name)
+
+
 class AuthBot(discord.Client):
-    def __init__(self, *, intents: discord.Intents, oauth: AzureOauth, dbc: DBC, config: Config, webserver_port: int):
+    def __init__(
+        self,
+        *,
+        intents: discord.Intents,
+        oauth: AzureOauth,
+        dbc: DBC,
+        config: Config,
+        webserver_port: int,
+        webserver_compress: bool = False,
+        admission: AdmissionController = None,
+        webserver_workers: int = 0,
+        metrics_port: int = 0,
+        creds: dict = None,
+        session_ttl: int = 3600,
+        redeemed_session_ttl: int = 86400,
+        session_gc_interval: int = 600,
+        ialab_revalidate: float = 86400,
+        team_deploy_workers: int = 4,
+        server_concurrency: int = 4,
+    ):
         super().__init__(intents=intents)
         self.oauth = oauth
         self.dbc = dbc
         self.config = config
         self.webserver_port = webserver_port
+        self.webserver_compress = webserver_compress
+        self.admission = admission if admission is not None else AdmissionController()
+        self.webserver_workers = webserver_workers
+        self.metrics_port = metrics_port
+        self.creds = creds
+        self._webserver_started = False
+        self._verifications: multiprocessing.Queue | None = None
+        self.session_ttl = session_ttl
+        self.redeemed_session_ttl = redeemed_session_ttl
+        self.session_gc_interval = session_gc_interval
+        self.ialab_revalidate = ialab_revalidate
+        self.team_deploy_workers = team_deploy_workers
+        self._server_slots = asyncio.Semaphore(server_concurrency)
+        self._background: set[asyncio.Task] = set()
 
         self.tree = discord.app_commands.CommandTree(self)
+        self.tree.on_error = self.on_command_error
 
     @classmethod
     def create_from_creds(cls, creds: dict):
         """Create an instance of the bot from a creds dict"""
         instance = cls(
             intents=discord.Intents.all(),
-            oauth=AzureOauth(
-                client_id=creds["oauth"]["client_id"],
-                secret=creds["oauth"]["client_secret"],
-                scopes=["openid+User.Read"],
-                redirect_uri="https://auth.defsec.club/azure/auth",
-            ),
-            dbc=DBC(
-                host=creds["db"]["host"],
-                user=creds["db"]["user"],
-                password=creds["db"]["password"],
-                db=creds["db"]["db"],
-            ),
+            oauth=AzureOauth.from_creds(creds),
+            dbc=DBC.from_creds(creds),
             config=Config("config.json"),
             webserver_port=int(creds["webserver_port"]),
+            webserver_compress=bool(creds.get("webserver_compress", False)),
+            admission=AdmissionController(**creds.get("webserver_admission", {})),
+            webserver_workers=int(creds.get("webserver_workers", 0)),
+            metrics_port=int(creds.get("metrics_port", 0)),
+            creds=creds,
+            session_ttl=int(creds["oauth"].get("session_ttl", 3600)),
+            redeemed_session_ttl=int(creds["oauth"].get("redeemed_session_ttl", 86400)),
+            session_gc_interval=int(creds["oauth"].get("session_gc_interval", 600)),
+            ialab_revalidate=float(creds["defsec_api"].get("ialab_revalidate", 86400)),
+            team_deploy_workers=int(creds["defsec_api"].get("team_deploy_workers", 4)),
+            server_concurrency=int(creds.get("server_concurrency", 4)),
         )
 
         async def command_deploy_autocompletion(
             interaction: discord.Interaction, current: str
         ) -> list[discord.app_commands.Choice[str]]:
-            data = []
             if len(current) < 2:
-                return data
-            for vapp in list((await defsecapi.get_templates(partial=current, catalog=None)).keys()):
-                data.append(discord.app_commands.Choice(name=vapp, value=vapp))
-                if len(data) > 24:
-                    break
-            return data
+                return []
+            return [
+                discord.app_commands.Choice(name=vapp, value=vapp)
+                for vapp in template_index.search(current, catalog=None, limit=25)
+            ]
 
         async def command_lesson_autocompletion(
                 interaction: discord.Interaction, current: str
         ) -> list[discord.app_commands.Choice[str]]:
-            data = []
             if len(current) < 2:
-                return data
-            for vapp in list((await defsecapi.get_lessons(current)).keys()):
-                data.append(discord.app_commands.Choice(name=vapp, value=vapp))
-                if len(data) > 24:
-                    break
-            return data
+                return []
+            return [
+                discord.app_commands.Choice(name=vapp, value=vapp)
+                for vapp in template_index.search(current, catalog=TemplateIndex.LESSONS, limit=25)
+            ]
 
         async def command_share_autocompletion(
                 interaction: discord.Interaction, current: str
@@ -284,7 +287,7 @@ class AuthBot(discord.Client):
                 return data
             for name, vapp_id in list((await defsecapi.get_vapps_for_owner(current, user.ialab_username)).items()):
                 data.append(discord.app_commands.Choice(name=name, value=name))
-                if len(data) > 64:
+                if len(data) > 24:
                     break
             return data
 
@@ -292,7 +295,7 @@ class AuthBot(discord.Client):
         @discord.app_commands.autocomplete(template=command_deploy_autocompletion)
         async def command_deploy(interaction: discord.Interaction, template: str) -> None:
             """/deploy <template>"""
-            if (template_id := await defsecapi.get_template_id(template)) is not None:
+            if (template_id := await template_index.get_template_id(template)) is not None:
                 logger.info(f"Deploy button for {template} by {interaction.user}")
                 # noinspection PyUnresolvedReferences
                 await interaction.response.send_message(
@@ -308,7 +311,10 @@ class AuthBot(discord.Client):
             """/verify"""
             user = interaction.user
             await instance.dbc.add_user(user)
-            session = await instance.dbc.init_oauth_session(user.id)
+            if instance.oauth.stateless:
+                session = instance.oauth.sign_state(user.id)
+            else:
+                session = await instance.dbc.init_oauth_session(user.id)
             oauth_url = instance.oauth.request(session)
             user_obj = await instance.dbc.get_user(user.id)
             logger.info(f"Auth request from: {user} {user_obj if user_obj.email is not None else ''}")
@@ -371,8 +377,13 @@ class AuthBot(discord.Client):
             # noinspection PyUnresolvedReferences
             await interaction.response.defer(ephemeral=True, thinking=True)
 
-            to_share = {member.mention: (await bot.dbc.get_user(member.id)).ialab_username for member in who.members}
+            users = await bot.dbc.get_users(member.id for member in who.members)
+            to_share = {
+                member.mention: users[member.id].ialab_username if member.id in users else None
+                for member in who.members
+            }
 
+            defsecapi.invalidate_vapps(user.ialab_username)
             if await defsecapi.share_vapp(vapp_id, [iu for iu in to_share.values() if iu is not None]):
                 await interaction.followup.send(
                     embed=discord.Embed(
@@ -394,7 +405,7 @@ class AuthBot(discord.Client):
         @discord.app_commands.autocomplete(template=command_lesson_autocompletion)
         async def command_deploy(interaction: discord.Interaction, template: str) -> None:
             """/lesson <template>"""
-            if (template_id := (await defsecapi.get_lessons(template)).get(template, None)) is not None:
+            if (template_id := await template_index.get_template_id(template, TemplateIndex.LESSONS)) is not None:
                 logger.info(f"Deploy button for {template} by {interaction.user}")
                 # noinspection PyUnresolvedReferences
                 await interaction.response.send_message(
@@ -406,39 +417,106 @@ class AuthBot(discord.Client):
                 # noinspection PyUnresolvedReferences
                 await interaction.response.send_message(content=f"Unknown template `{template}`!", ephemeral=True)
 
-        # @instance.tree.command(name="deploy_team", description="Deploy vapp to a team")
-        # @discord.app_commands.autocomplete(template=command_deploy_autocompletion)
-        # async def command_deploy_team(
-        #     interaction: discord.Interaction,
-        #     template: str,
-        #     team_name: str,
-        #     members: discord.Member,
-        # ) -> None:
-        #     """/deploy_team deploy vapp to a team of users"""
-        #     if (template_id := await defsecapi.get_template_id(template)) is not None:
-        #         logger.info(f"Deploy button for {template} by {interaction.user}")
-        #
-        #         users = [await bot.dbc.get_user(m.id) for m in members]
-        #         if None in users:
-        #             await interaction.response.send_message(
-        #                 embed=discord.Embed(
-        #                     title="No IALab user set for:",
-        #                     description="\n".join(members[i].mention for i, u in enumerate(users) if u is None),
-        #                 ),
-        #                 ephemeral=True,
-        #             )
-        #             return
-        #
-        #         await interaction.response.defer(ephemeral=True, thinking=True)
-        #
-        #         vapp_url = await defsecapi.deploy_team(team_name, users=users, template_id=template_id)
-        #         await interaction.followup.send(view=UrlButton(label="Deployed!", url=vapp_url), ephemeral=True)
-        #     else:
-        #         # noinspection PyUnresolvedReferences
-        #         await interaction.response.send_message(content=f"Unknown template `{template}`!", ephemeral=True)
+        @instance.tree.command(name="deploy_team", description="Deploy vapp to every team role")
+        @discord.app_commands.default_permissions(manage_roles=True)
+        @discord.app_commands.autocomplete(template=command_deploy_autocompletion)
+        async def command_deploy_team(interaction: discord.Interaction, template: str, team_prefix: str) -> None:
+            """/deploy_team <template> <team_prefix> deploy vapp to each role named team_prefix..."""
+            if (template_id := await template_index.get_template_id(template)) is None:
+                # noinspection PyUnresolvedReferences
+                await interaction.response.send_message(content=f"Unknown template `{template}`!", ephemeral=True)
+                return
+
+            teams = [role for role in interaction.guild.roles if role.name.startswith(team_prefix)]
+            if not teams:
+                # noinspection PyUnresolvedReferences
+                await interaction.response.send_message(content=f"No roles start with `{team_prefix}`!", ephemeral=True)
+                return
+
+            users = await instance.dbc.get_users(member.id for team in teams for member in team.members)
+            missing = {
+                member.mention
+                for team in teams
+                for member in team.members
+                if member.id not in users or users[member.id].ialab_username is None
+            }
+            if missing:
+                # noinspection PyUnresolvedReferences
+                await interaction.response.send_message(
+                    embed=discord.Embed(title="No IALab user set for:", description="\n".join(missing)),
+                    ephemeral=True,
+                )
+                return
+
+            logger.info(f"Team deploy of {template} to {len(teams)} teams by {interaction.user}")
+            # noinspection PyUnresolvedReferences
+            await interaction.response.send_message(
+                content=f"Deploying `{template}` to {len(teams)} teams, progress is posted below", ephemeral=True
+            )
+            progress = ProgressEmbed(f"Deploying `{template}`", (team.name for team in teams), "⏳ queued")
+            # Deploys can outlive the 15 minute interaction token so progress goes in a channel message the bot can edit
+            progress.start(await interaction.channel.send(embed=progress.embed))
+            workers = asyncio.Semaphore(instance.team_deploy_workers)
+
+            async def deploy_team(team: discord.Role):
+                async with workers:
+                    progress.update(team.name, "🔨 deploying")
+                    try:
+                        vapp_url = await defsecapi.deploy_team(
+                            team.name,
+                            users=[users[member.id].ialab_username for member in team.members],
+                            template_id=template_id,
+                        )
+                    except Exception as e:
+                        logger.warning(f"Team deploy to {team} failed: {e}")
+                        vapp_url = None
+                    progress.update(team.name, f"[ready]({vapp_url})" if vapp_url is not None else "❌ failed")
+
+            await asyncio.gather(*(deploy_team(team) for team in teams))
+            await progress.finish()
 
         return instance
 
+    async def setup_hook(self) -> None:
+        """Open the database pool before connecting to the gateway"""
+        await self.dbc.connect()
+        self.loop.create_task(self.expire_sessions())
+        self.loop.create_task(template_index.run())
+        self.loop.create_task(warm_pool.start())
+
+    async def expire_sessions(self) -> None:
+        """Periodically delete expired oauth sessions. Infinitely blocking"""
+        while not self.is_closed():
+            try:
+                purged = await self.dbc.purge_oauth_sessions(self.session_ttl, self.redeemed_session_ttl)
+                if purged:
+                    logger.info(f"Purged {purged} expired oauth sessions")
+            except Exception as e:
+                logger.warning(f"Could not purge oauth sessions: {e}")
+            await asyncio.sleep(self.session_gc_interval)
+
+    async def close(self) -> None:
+        """Close the database pool and api session on shutdown"""
+        await super().close()
+        if self._verifications is not None:
+            self._verifications.put(None)
+        await self.dbc.close()
+        await self.oauth.close()
+        await defsecapi.close()
+
+    @staticmethod
+    async def on_command_error(interaction: discord.Interaction, error: discord.app_commands.AppCommandError) -> None:
+        """Fired when a slash command fails"""
+        ERRORS.inc(source="command")
+        if interaction.command is not None:
+            observe_command(interaction, interaction.command)
+        await send_error(interaction, getattr(error, "original", error))
+
+    @staticmethod
+    async def on_app_command_completion(interaction: discord.Interaction, command) -> None:
+        """Fired when a slash command finishes"""
+        observe_command(interaction, command)
+
     async def on_ready(self):
         """
         Fired when the bot had fully loaded.
@@ -446,22 +524,54 @@ class AuthBot(discord.Client):
         """
         logger.info(f"Logged in as {self.user}")
 
-        server = await self.loop.create_server(lambda: RedirectReceiver(), "127.0.0.1", self.webserver_port)
-        logger.info(f"Webserver listening on 127.0.0.1:{self.webserver_port}")
-        self.loop.create_task(start_webserver(server))
+        if not self._webserver_started:
+            self._webserver_started = True
+            await self.start_callback_server()
 
         await self.tree.sync()
 
         # Add all known users to the db to get first contact time
-        known_users = []
+        known_users = {}
         for guild in self.guilds:
             logger.info(f"Initializing members in {guild}")
             async for member in guild.fetch_members(limit=None):
-                if member.id not in known_users:
-                    known_users.append(member.id)
-                    await self.dbc.add_user(member)
+                known_users.setdefault(member.id, member)
+        await self.dbc.add_users(known_users.values())
         logger.info(f"Total users: {len(known_users)}")
 
+    async def start_callback_server(self) -> None:
+        """Serve oauth callbacks in this process or start worker processes to do it"""
+        if self.metrics_port:
+            # Every process keeps its own metrics, workers serve theirs on the following ports
+            self.loop.create_task(start_metrics_server(self.metrics_port))
+        if self.webserver_workers <= 0:
+            server = await self.loop.create_server(
+                lambda: RedirectReceiver(
+                    self.verify_member, compress=self.webserver_compress, admission=self.admission
+                ),
+                "127.0.0.1",
+                self.webserver_port,
+            )
+            logger.info(f"Webserver listening on 127.0.0.1:{self.webserver_port}")
+            self.loop.create_task(start_webserver(server))
+            return
+
+        context = multiprocessing.get_context("spawn")
+        self._verifications = context.Queue()
+        for i in range(self.webserver_workers):
+            context.Process(
+                target=run_worker, args=(self.creds, self._verifications, i), name=f"webserver-{i}", daemon=True
+            ).start()
+        logger.info(f"Started {self.webserver_workers} webserver workers on 127.0.0.1:{self.webserver_port}")
+        self.loop.create_task(self.receive_verifications())
+
+    async def receive_verifications(self) -> None:
+        """Apply verifications redeemed by webserver workers. Infinitely blocking"""
+        while (verification := await self.loop.run_in_executor(None, self._verifications.get)) is not None:
+            # The worker saved the user through its own connection so this process's cached copy is stale
+            self.dbc.user_cache.invalidate(verification.user_id)
+            self.apply_in_background(verification)
+
     async def on_member_join(self, member: discord.Member) -> None:
         """Fired when a member joins a server"""
         logger.info(f"+{member} in {member.guild}")
@@ -509,54 +619,177 @@ class AuthBot(discord.Client):
 
     async def verify_member(self, state: str, code: str) -> str:
         """
-        Verify an oauth response
+        Verify an oauth response.
+        The user is answered once the verification is saved, roles and logs are applied in the background
         :param state: oauth state code
         :param code: oauth authorization code
         :return: Status message for user
         """
-        user_id = await self.dbc.get_state_user_id(state)
-        if user_id is None:
-            return "Invalid or expired code 🙁"
-        access_token = await self.oauth.get_access_token(code)
-        if access_token is None:
-            access_token = await self.dbc.get_access_token(code)
-        if access_token is None:
-            return "Invalid or expired code 🙁"
-        # Not enough padding = :( Extra padding = :)
-        user_info = json.loads(base64.b64decode(access_token.split(".")[1] + "===").decode())
-        email = user_info["unique_name"]
-        last_name, first_name = user_info["family_name"], user_info["given_name"]
-        position = get_position(email)
-        name = f"{first_name} {last_name}"
-        username = self.get_user(int(user_id)).name
-
-        await self.dbc.update_session(state, code=code, access_token=access_token)
-        await self.dbc.update_user(user_id, email=email, name=name, position=position, username=username)
+        result = await redeem_oauth(self.dbc, self.oauth, state, code)
+        if isinstance(result, str):
+            return result
+        self.apply_in_background(result)
+        return "Verified 👍"
+
+    def apply_in_background(self, verification: Verification) -> None:
+        """Apply a verification without waiting for it, logging any failure"""
+        task = self.loop.create_task(self.apply_verification(verification), name=f"verify {verification.user_id}")
+        # Keep a reference so the task is not garbage collected while running
+        self._background.add(task)
+        task.add_done_callback(self._background_done)
+
+    def _background_done(self, task: asyncio.Task) -> None:
+        self._background.discard(task)
+        if not task.cancelled() and (e := task.exception()) is not None:
+            ERRORS.inc(source="verification")
+            logger.warning(f"Could not apply {task.get_name()}: {e}")
+
+    async def apply_verification(self, verification: Verification) -> None:
+        """Log a verification and fix the user's nick and roles in every server concurrently"""
+        user_id, email = verification.user_id, verification.email
+        username = None
+        if (discord_user := self.get_user(user_id)) is not None:
+            username = discord_user.name
+            await self.dbc.add_user(discord_user)
 
         with open("verify.log", "a") as log:
             log.write(f"{datetime.now()} {username} ({user_id}) => {email}\n")
 
         logger.info(f"Verified {username} ({user_id}) to {email}")
-        for server_id, server in self.config.servers.items():
+        await asyncio.gather(
+            *(
+                self.apply_verification_in_server(verification, server_id, server)
+                for server_id, server in self.config.servers.items()
+            )
+        )
+
+    async def apply_verification_in_server(self, verification: Verification, server_id: str, server: dict) -> None:
+        """Fix the user's nick and roles in one server and write to its verify log"""
+        user_id, email = verification.user_id, verification.email
+        name, position = verification.name, verification.position
+        try:
+            member = self.get_guild(int(server_id)).get_member(int(user_id))
+        except (ValueError, AttributeError):
+            # User not in server
+            return
+        async with self._server_slots:
             try:
-                member = self.get_guild(int(server_id)).get_member(int(user_id))
-            except (ValueError, AttributeError):
-                # User not in server
-                continue
-            await self.confirm_roles(member)
+                await self.confirm_roles(member)
+            except discord.errors.HTTPException as e:
+                logger.warning(f"Could not confirm roles for {user_id} in {server_id}: {e}")
             try:
                 if "verify_log" in server:
                     await self.get_channel(int(server["verify_log"])).send(
                         f"{position.capitalize()} {name} ({email}) linked {f'external: <@{user_id}>' if member is None else member.mention}"
                     )
-            except (ValueError, AttributeError):
+            except (ValueError, AttributeError, discord.errors.HTTPException):
                 logger.warning(f"Could not write to verify log channel {server.get('verify_log', '')} in {server_id}")
-        return "Verified 👍"
-
-
-with open("creds.json") as c:
-    creds = json.load(c)
 
-defsecapi = DefSecApi(host=creds["defsec_api"]["host"], api_key=creds["defsec_api"]["key"])
-bot = AuthBot.create_from_creds(creds)
-bot.run(creds["token"])
+# Built in main() so spawned webserver workers can import this module without starting another bot
+defsecapi: DefSecApi
+deploy_batcher: DeployBatcher
+deploy_scheduler: DeployScheduler
+template_index: TemplateIndex
+bot: AuthBot
+warm_pool: WarmPool
+
+
+def main() -> None:
+    global defsecapi, deploy_batcher, deploy_scheduler, template_index, bot, warm_pool
+    with open("creds.json") as c:
+        creds = json.load(c)
+
+    defsecapi = DefSecApi(
+        host=creds["defsec_api"]["host"],
+        api_key=creds["defsec_api"]["key"],
+        connection_limit=int(creds["defsec_api"].get("connection_limit", 20)),
+        timeout=float(creds["defsec_api"].get("timeout", 30)),
+        coalesce_ttl=float(creds["defsec_api"].get("coalesce_ttl", 5)),
+        vapp_list_ttl=float(creds["defsec_api"].get("vapp_list_ttl", 60)),
+        timeouts=creds["defsec_api"].get("timeouts"),
+    )
+    # deploy_concurrency limits deploy calls to the api, each carrying up to deploy_batch_size users.
+    # The scheduler admits enough users to fill every batch
+    deploy_batcher = DeployBatcher(
+        lambda usernames, template_id: defsecapi.deploy_lessons(usernames, template_id=template_id),
+        window=float(creds["defsec_api"].get("deploy_batch_window", 1)),
+        max_batch=int(creds["defsec_api"].get("deploy_batch_size", 20)),
+        concurrency=int(creds["defsec_api"].get("deploy_concurrency", 5)),
+    )
+    deploy_scheduler = DeployScheduler(
+        deploy_batcher.deploy,
+        concurrency=deploy_batcher.concurrency * deploy_batcher.max_batch,
+    )
+    template_index = TemplateIndex(
+        defsecapi,
+        catalogs=[None, TemplateIndex.LESSONS],
+        refresh_interval=float(creds["defsec_api"].get("template_refresh", 300)),
+    )
+    bot = AuthBot.create_from_creds(creds)
+    warm_pool = WarmPool(
+        defsecapi,
+        bot.dbc,
+        {template_id: int(size) for template_id, size in creds["defsec_api"].get("warm_pool", {}).items()},
+    )
+
+    Gauge("authbot_deploys_queued", "Deploys waiting for a scheduler slot", lambda: deploy_scheduler.queued)
+    Gauge("authbot_deploys_running", "Deploys holding a scheduler slot", lambda: deploy_scheduler.running)
+    Gauge("authbot_deploy_actions_polling", "Deploy actions being polled", lambda: defsecapi.poller.in_flight)
+    Gauge(
+        "authbot_deploy_batches_total",
+        "Batched deploy calls",
+        lambda: {("deploys",): deploy_batcher.stats["deploys"], ("batches",): deploy_batcher.stats["batches"]},
+        labels=("kind",),
+        kind="counter",
+    )
+    Gauge(
+        "authbot_warm_pool_claims_total",
+        "Warm pool claims by result",
+        lambda: {(result,): count for result, count in warm_pool.stats.items()},
+        labels=("result",),
+        kind="counter",
+    )
+    Gauge(
+        "authbot_api_calls_total",
+        "DefSec api calls and how many were deduplicated",
+        lambda: {(kind,): count for kind, count in defsecapi.coalesce_stats.items()},
+        labels=("kind",),
+        kind="counter",
+    )
+    Gauge(
+        "authbot_circuit_open",
+        "Whether an outbound circuit breaker is refusing calls",
+        lambda: {
+            (state["name"],): int(state["state"] != CircuitBreaker.CLOSED)
+            for state in (defsecapi.policy.state, bot.oauth.policy.state)
+        },
+        labels=("dependency",),
+    )
+    Gauge(
+        "authbot_retry_tokens",
+        "Retries an outbound dependency may still spend",
+        lambda: {(state["name"],): state["retry_tokens"] for state in (defsecapi.policy.state, bot.oauth.policy.state)},
+        labels=("dependency",),
+    )
+    Gauge("authbot_user_cache_size", "Users in the cache", lambda: len(bot.dbc.user_cache))
+    Gauge(
+        "authbot_user_cache_total",
+        "User cache lookups by result",
+        lambda: {("hits",): bot.dbc.user_cache.hits, ("misses",): bot.dbc.user_cache.misses},
+        labels=("result",),
+        kind="counter",
+    )
+    Gauge("authbot_callbacks_active", "Oauth callbacks being verified", lambda: bot.admission.active)
+    Gauge("authbot_callbacks_waiting", "Oauth callbacks waiting for a verification slot", lambda: bot.admission.waiting)
+    Gauge(
+        "authbot_callbacks_admission_total",
+        "Oauth callbacks by admission result",
+        lambda: {(result,): count for result, count in bot.admission.stats.items()},
+        labels=("result",),
+        kind="counter",
+    )
+    bot.run(creds["token"])
+
+
+if __name__ == "__main__":
+    main()
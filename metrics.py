@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# @Name: metrics.py
+# @Project: DSUAuthBot/
+import bisect
+import contextlib
+import time
+from typing import Callable
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Registry:
+    """Collection of metrics rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    """Monotonically increasing count"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+        registry.register(self)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels[name] for name in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge:
+    """Current value read from a callback when rendered"""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        read: Callable[[], float | dict[tuple, float]],
+        labels: tuple[str, ...] = (),
+        kind: str = "gauge",
+        registry: Registry = REGISTRY,
+    ):
+        """
+        :param read: Returns the value, or a dict of label values to value when labels are set
+        :param kind: Prometheus type, use counter for callbacks reading running totals
+        """
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labels = labels
+        self.kind = kind
+        registry.register(self)
+
+    def samples(self) -> list[str]:
+        try:
+            values = self.read()
+        except Exception:
+            return []
+        if not self.labels:
+            values = {(): values}
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in values.items()]
+
+
+class Histogram:
+    """Distribution of observed values, usually latencies in seconds"""
+
+    kind = "histogram"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = BUCKETS,
+        registry: Registry = REGISTRY,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [bucket counts..., sum, count], observations above the last bucket only reach +Inf
+        self.values: dict[tuple, list[float]] = {}
+        registry.register(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels[name] for name in self.labels)
+        if (counts := self.values.get(key)) is None:
+            counts = self.values[key] = [0] * (len(self.buckets) + 2)
+        if (index := bisect.bisect_left(self.buckets, value)) < len(self.buckets):
+            counts[index] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe how long the block takes, including blocks that raise"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {counts[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {counts[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {counts[-1]}")
+        return lines
+
+
+VERIFY_LATENCY = Histogram("authbot_verify_seconds", "Time to answer an oauth callback")
+VERIFICATIONS = Counter("authbot_verifications_total", "Oauth callbacks by result", ("result",))
+DB_LATENCY = Histogram("authbot_db_query_seconds", "Database query time", ("query",))
+OAUTH_LATENCY = Histogram("authbot_oauth_token_seconds", "Time to redeem an authorization code")
+API_LATENCY = Histogram("authbot_api_request_seconds", "DefSec api request time", ("endpoint",))
+COMMAND_LATENCY = Histogram("authbot_command_seconds", "Slash command time from interaction creation", ("command",))
+DEPLOYS = Counter("authbot_deploys_total", "vApp deploys requested from buttons by result", ("result",))
+ERRORS = Counter("authbot_errors_total", "Errors by source", ("source",))
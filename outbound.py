@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# @Name: outbound.py
+# @Project: DSUAuthBot/
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, TypeVar
+
+import aiohttp
+
+logger = logging.getLogger("authbot")
+
+T = TypeVar("T")
+
+
+class DependencyUnavailable(Exception):
+    """Raised instead of calling a dependency whose circuit breaker is open"""
+
+    def __init__(self, name: str):
+        super().__init__(f"{name} is unavailable")
+        self.name = name
+        self.message = f"{name} is having problems right now, please try again in a few minutes 😢"
+
+
+class CircuitBreaker:
+    """Stops calling a dependency after repeated failures, letting a single trial call through after a cool down"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, *, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened = 0.0
+        self._trial = False
+
+    def before_call(self) -> None:
+        """
+        Check the breaker before making a call
+        :raises DependencyUnavailable: If the breaker is open
+        """
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened < self.reset_timeout:
+                raise DependencyUnavailable(self.name)
+            self.state = self.HALF_OPEN
+            self._trial = False
+        if self.state == self.HALF_OPEN:
+            # A trial that never reported back (ex. cancelled) does not block the breaker forever
+            if self._trial and time.monotonic() - self._opened < self.reset_timeout:
+                raise DependencyUnavailable(self.name)
+            self._trial = True
+            self._opened = time.monotonic()
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.warning(f"Circuit breaker for {self.name} closed")
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit breaker for {self.name} opened after {self.failures} failures")
+            self.state = self.OPEN
+            self._opened = time.monotonic()
+
+
+class RetryBudget:
+    """Token bucket that only allows retries for a fraction of recent calls so retries cannot snowball"""
+
+    def __init__(self, *, ratio: float = 0.2, max_tokens: float = 10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self) -> None:
+        """Earn part of a retry for a call"""
+        self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self) -> bool:
+        """Spend a retry if one is available"""
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class OutboundPolicy:
+    """Timeouts, jittered retries and a circuit breaker shared by every call to one dependency"""
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        timeouts: dict[str, float] = None,
+        default_timeout: float = 10,
+        retries: int = 2,
+        retry_ratio: float = 0.2,
+        base_delay: float = 0.25,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+    ):
+        self.name = name
+        self.timeouts = timeouts or {}
+        self.default_timeout = default_timeout
+        self.retries = retries
+        self.base_delay = base_delay
+        self.breaker = CircuitBreaker(name, failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+        self.budget = RetryBudget(ratio=retry_ratio)
+
+    @property
+    def state(self) -> dict:
+        """Breaker and retry budget state for monitoring"""
+        return {
+            "name": self.name,
+            "state": self.breaker.state,
+            "failures": self.breaker.failures,
+            "retry_tokens": self.budget.tokens,
+        }
+
+    def timeout(self, endpoint: str) -> float:
+        """Seconds allowed for a call to an endpoint"""
+        return self.timeouts.get(endpoint, self.default_timeout)
+
+    async def call(
+        self,
+        endpoint: str,
+        call: Callable[[], Awaitable[T]],
+        *,
+        idempotent: bool = True,
+        failed: Callable[[T], bool] = None,
+    ) -> T:
+        """
+        Make a call under the policy
+        :param endpoint: Name used to pick the timeout
+        :param call: Coroutine function making the call
+        :param idempotent: Only idempotent calls are retried
+        :param failed: Whether a returned result counts as a failure (ex. a 5xx response).
+            Failed results are retried and returned once retries run out
+        :raises DependencyUnavailable: If the circuit breaker is open
+        """
+        self.breaker.before_call()
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                result = await asyncio.wait_for(call(), self.timeout(endpoint))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.breaker.record_failure()
+                if not self._retry(idempotent, attempt):
+                    raise
+                logger.info(f"Retrying {self.name} {endpoint} after {type(e).__name__}")
+            else:
+                if failed is None or not failed(result):
+                    self.breaker.record_success()
+                    return result
+                self.breaker.record_failure()
+                if not self._retry(idempotent, attempt):
+                    return result
+                logger.info(f"Retrying {self.name} {endpoint} after failed response")
+            attempt += 1
+            # Full jitter
+            await asyncio.sleep(random.uniform(0, self.base_delay * 2**attempt))
+            self.breaker.before_call()
+
+    def _retry(self, idempotent: bool, attempt: int) -> bool:
+        return idempotent and attempt < self.retries and self.budget.withdraw()
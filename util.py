@@ -6,16 +6,25 @@
 
 
 import asyncio
+import base64
+import contextlib
 import dataclasses
+import hashlib
+import hmac
 import json
 import logging
+import time
+from collections import OrderedDict
 from random import choice as rand_choice
 from string import ascii_letters, digits
-from typing import Callable, Coroutine
+from typing import Callable, Coroutine, Iterable
 
+import aiohttp
+import aiomysql
 import discord
-import pymysql
-import requests
+
+from metrics import DB_LATENCY, OAUTH_LATENCY, VERIFICATIONS
+from outbound import OutboundPolicy
 
 logger = logging.getLogger()
 
@@ -32,6 +41,60 @@ class UrlButton(discord.ui.View):
         )
 
 
+class ProgressEmbed:
+    """Single message listing the status of many jobs, edited at most once per interval"""
+
+    # Discord rejects embeds with longer descriptions
+    MAX_DESCRIPTION = 4096
+
+    def __init__(self, title: str, items: Iterable[str], status: str, interval: float = 2):
+        self.title = title
+        self.statuses = {item: status for item in items}
+        self.interval = interval
+        self.message: discord.WebhookMessage | discord.Message | None = None
+        self._dirty = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def embed(self) -> discord.Embed:
+        """Current status embed, listing as many items as fit followed by a count of the rest"""
+        lines = [f"**{item}**: {status}" for item, status in self.statuses.items()]
+        description = "\n".join(lines)
+        while len(description) > self.MAX_DESCRIPTION:
+            lines.pop()
+            description = "\n".join(lines) + f"\n…and {len(self.statuses) - len(lines)} more"
+        return discord.Embed(title=self.title, description=description)
+
+    def start(self, message: discord.WebhookMessage | discord.Message) -> None:
+        """Start editing a message already showing the embed"""
+        self.message = message
+        self._task = asyncio.create_task(self._edit_loop())
+
+    def update(self, item: str, status: str) -> None:
+        """Set the status of an item"""
+        self.statuses[item] = status
+        self._dirty.set()
+
+    async def finish(self) -> None:
+        """Write the final statuses"""
+        if self._task is not None:
+            self._task.cancel()
+        try:
+            await self.message.edit(embed=self.embed)
+        except discord.HTTPException as e:
+            logger.warning(f"Could not write final progress message: {e}")
+
+    async def _edit_loop(self) -> None:
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            try:
+                await self.message.edit(embed=self.embed)
+            except discord.HTTPException as e:
+                logger.warning(f"Could not update progress message: {e}")
+            await asyncio.sleep(self.interval)
+
+
 class BasicTextInput(discord.ui.Modal):
     def __init__(
         self,
@@ -131,11 +194,96 @@ class Config:
         return self._data["servers"]
 
 
+class TTLCache:
+    """Bounded LRU cache whose entries expire after a fixed time to live"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        """Get a live entry, counting the hit or miss"""
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value) -> None:
+        """Insert or refresh an entry, evicting the least recently used one when full"""
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        """Drop an entry if present"""
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Drop every entry"""
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Hit/miss counters and current size"""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+
+def _column_check(table: str, column: str) -> str:
+    """Migration check query for an existing column"""
+    return (
+        "SELECT 1 FROM information_schema.columns WHERE table_schema = DATABASE() "
+        f"AND table_name = '{table}' AND column_name = '{column}';"
+    )
+
+
+def _index_check(table: str, index: str) -> str:
+    """Migration check query for an existing index"""
+    return (
+        "SELECT 1 FROM information_schema.statistics WHERE table_schema = DATABASE() "
+        f"AND table_name = '{table}' AND index_name = '{index}' LIMIT 1;"
+    )
+
+
+def _missing_check(check: str) -> str:
+    """Invert a migration check query"""
+    return f"SELECT 1 FROM DUAL WHERE NOT EXISTS ({check.rstrip(';')});"
+
+
+def get_token_claims(access_token: str) -> dict:
+    """Decode the claims verification needs from an access token"""
+    # Not enough padding = :( Extra padding = :)
+    claims = json.loads(base64.b64decode(access_token.split(".")[1] + "===").decode())
+    return {key: claims[key] for key in ("unique_name", "family_name", "given_name")}
+
+
+def hash_code(code: str) -> bytes:
+    """Fixed width key for an authorization code"""
+    return hashlib.sha256(code.encode()).digest()
+
+
 class DBC:
     """Database connection manager"""
 
-    TABLES = [
-        """CREATE TABLE IF NOT EXISTS users (
+    # Each migration is a list of (check, statement) pairs applied in order. A statement is skipped
+    # when its check query returns a row so a partially applied migration can safely run again.
+    MIGRATIONS = [
+        # 1: Initial tables
+        [
+            (
+                None,
+                """CREATE TABLE IF NOT EXISTS users (
 id            BIGINT(20)                                                            NOT NULL PRIMARY KEY,
 discord_tag   VARCHAR(40)                                                           NOT NULL,
 email         VARCHAR(64)                                                           NULL,
@@ -145,7 +293,10 @@ ialab_user    VARCHAR(64)
 first_seen    TIMESTAMP                                                             NULL,
 verify_date   TIMESTAMP                                                             NULL
        );""",
-        """CREATE TABLE IF NOT EXISTS oauth (
+            ),
+            (
+                None,
+                """CREATE TABLE IF NOT EXISTS oauth (
 state              CHAR(16)                              NOT NULL,
 user_id            BIGINT(20)                            NOT NULL,
 authorization_code VARCHAR(2048)                         NULL,
@@ -153,6 +304,57 @@ access_token       VARCHAR(8192)                         NULL,
 time               TIMESTAMP DEFAULT CURRENT_TIMESTAMP() NOT NULL ON UPDATE CURRENT_TIMESTAMP(),
 CONSTRAINT user_id FOREIGN KEY (user_id) REFERENCES users (id) ON UPDATE CASCADE ON DELETE CASCADE
 );""",
+            ),
+        ],
+        # 2: Index oauth lookups and fix the ialab username column name
+        [
+            (
+                _column_check("users", "ialab_username"),
+                "ALTER TABLE users CHANGE ialab_user ialab_username VARCHAR(64) NULL;",
+            ),
+            (_index_check("oauth", "PRIMARY"), "ALTER TABLE oauth ADD PRIMARY KEY (state);"),
+            (
+                _index_check("oauth", "oauth_authorization_code"),
+                "ALTER TABLE oauth ADD INDEX oauth_authorization_code (authorization_code(191));",
+            ),
+            (_index_check("oauth", "oauth_user_id"), "ALTER TABLE oauth ADD INDEX oauth_user_id (user_id);"),
+        ],
+        # 3: Room for signed states
+        [(None, "ALTER TABLE oauth MODIFY state VARCHAR(64) NOT NULL;")],
+        # 4: Store a hash of the authorization code and the token claims instead of the raw values
+        [
+            (_column_check("oauth", "code_hash"), "ALTER TABLE oauth ADD COLUMN code_hash BINARY(32) NULL;"),
+            (_column_check("oauth", "claims"), "ALTER TABLE oauth ADD COLUMN claims VARCHAR(512) NULL;"),
+            (
+                _missing_check(_column_check("oauth", "authorization_code")),
+                "UPDATE oauth SET code_hash = UNHEX(SHA2(authorization_code, 256)) WHERE authorization_code IS NOT NULL;",
+            ),
+            (_index_check("oauth", "oauth_code_hash"), "ALTER TABLE oauth ADD INDEX oauth_code_hash (code_hash);"),
+            (
+                _missing_check(_index_check("oauth", "oauth_authorization_code")),
+                "ALTER TABLE oauth DROP INDEX oauth_authorization_code;",
+            ),
+            (
+                _missing_check(_column_check("oauth", "authorization_code")),
+                "ALTER TABLE oauth DROP COLUMN authorization_code;",
+            ),
+            (_missing_check(_column_check("oauth", "access_token")), "ALTER TABLE oauth DROP COLUMN access_token;"),
+        ],
+        # 5: Remember when each IALab username was last validated
+        [(_column_check("users", "ialab_validated"), "ALTER TABLE users ADD COLUMN ialab_validated TIMESTAMP NULL;")],
+        # 6: Pre-deployed lesson vApps waiting to be handed out
+        [
+            (
+                None,
+                """CREATE TABLE IF NOT EXISTS warm_pool (
+vapp_id     VARCHAR(64)                           NOT NULL PRIMARY KEY,
+template_id VARCHAR(64)                           NOT NULL,
+created     TIMESTAMP DEFAULT CURRENT_TIMESTAMP() NOT NULL
+);""",
+            )
+        ],
+        # 7: Index session age so expired sessions are purged without scanning the table
+        [(_index_check("oauth", "oauth_time"), "ALTER TABLE oauth ADD INDEX oauth_time (time);")],
     ]
 
     @dataclasses.dataclass
@@ -163,27 +365,122 @@ CONSTRAINT user_id FOREIGN KEY (user_id) REFERENCES users (id) ON UPDATE CASCADE
         name: str
         position: str
         ialab_username: str
+        ialab_validated: float | None = None
 
-    def __init__(self, *, host: str, user: str, password: str, db: str):
-        self.db = pymysql.connect(
-            host=host,
-            user=user,
-            password=password,
-            db=db,
-            autocommit=True,
+        def ialab_validated_within(self, seconds: float) -> bool:
+            """Whether the IALab username was validated in the last seconds"""
+            return self.ialab_validated is not None and time.time() - self.ialab_validated < seconds
+
+    def __init__(
+        self,
+        *,
+        host: str,
+        user: str,
+        password: str,
+        db: str,
+        pool_size: int = 10,
+        pool_recycle: int = 3600,
+        idle_ping: float = 60,
+        batch_size: int = 500,
+        user_cache_size: int = 4096,
+        user_cache_ttl: float = 300,
+    ):
+        self._connect_args = dict(host=host, user=user, password=password, db=db, autocommit=True)
+        self.pool_size = pool_size
+        self.pool_recycle = pool_recycle
+        self.idle_ping = idle_ping
+        self.batch_size = batch_size
+        self.user_cache = TTLCache(maxsize=user_cache_size, ttl=user_cache_ttl)
+        self.pool: aiomysql.Pool | None = None
+
+    @classmethod
+    def from_creds(cls, creds: dict) -> "DBC":
+        """Create a connection manager from a creds dict"""
+        return cls(
+            host=creds["db"]["host"],
+            user=creds["db"]["user"],
+            password=creds["db"]["password"],
+            db=creds["db"]["db"],
+            pool_size=int(creds["db"].get("pool_size", 10)),
+            batch_size=int(creds["db"].get("batch_size", 500)),
+            user_cache_size=int(creds["db"].get("user_cache_size", 4096)),
+            user_cache_ttl=float(creds["db"].get("user_cache_ttl", 300)),
+        )
+
+    async def connect(self) -> None:
+        """Open the connection pool and bring the schema up to date"""
+        self.pool = await aiomysql.create_pool(
+            minsize=1,
+            maxsize=self.pool_size,
+            pool_recycle=self.pool_recycle,
+            **self._connect_args,
         )
-        self._cursor = self.db.cursor()
-        for table in self.TABLES:
-            self._cursor.execute(table)
-        self.lock = asyncio.Lock()
-
-    async def _execute(self, query: str, args: tuple, response: bool = False) -> tuple | None:
-        async with self.lock:
-            self.db.ping()  # reconnect=True
-            self._cursor.execute(query, args)
-            self.db.commit()
-            if response:
-                return self._cursor.fetchone()
+        await self.migrate()
+        logger.info(f"Database pool ready ({self.pool_size} connections)")
+
+    async def migrate(self) -> int:
+        """
+        Apply any pending schema migrations
+        :return: Schema version of the database
+        """
+        async with self._connection() as conn:
+            async with conn.cursor() as cursor:
+                # Serialize migrations between processes sharing the database
+                await cursor.execute("SELECT GET_LOCK('authbot_migrate', 60);")
+                try:
+                    await cursor.execute(
+                        """CREATE TABLE IF NOT EXISTS schema_version (
+version INT                                   NOT NULL PRIMARY KEY,
+applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP() NOT NULL
+);"""
+                    )
+                    await cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+                    (version,) = await cursor.fetchone()
+                    for version, steps in enumerate(self.MIGRATIONS[version:], start=version + 1):
+                        for check, statement in steps:
+                            if check is not None:
+                                await cursor.execute(check)
+                                if await cursor.fetchone() is not None:
+                                    continue
+                            await cursor.execute(statement)
+                        await cursor.execute("INSERT INTO schema_version (version) VALUES (%s);", (version,))
+                        logger.info(f"Applied schema migration {version}")
+                finally:
+                    await cursor.execute("SELECT RELEASE_LOCK('authbot_migrate');")
+        return version
+
+    async def close(self) -> None:
+        """Close all pooled connections"""
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+
+    @contextlib.asynccontextmanager
+    async def _connection(self):
+        """
+        Acquire a pooled connection.
+        Only connections that sat idle longer than idle_ping are health checked
+        """
+        async with self.pool.acquire() as conn:
+            if asyncio.get_running_loop().time() - conn.last_usage > self.idle_ping:
+                await conn.ping(reconnect=True)
+            yield conn
+
+    async def _execute(self, query: str, args: tuple, response: bool = False, *, name: str) -> tuple | int | None:
+        """Run a query, returning the first row if response is set otherwise the affected row count"""
+        with DB_LATENCY.time(query=name):
+            async with self._connection() as conn, conn.cursor() as cursor:
+                await cursor.execute(query, args)
+                if response:
+                    return await cursor.fetchone()
+                return cursor.rowcount
+
+    async def _fetchall(self, query: str, args: tuple, *, name: str) -> tuple:
+        with DB_LATENCY.time(query=name):
+            async with self._connection() as conn, conn.cursor() as cursor:
+                await cursor.execute(query, args)
+                return await cursor.fetchall()
 
     async def init_oauth_session(self, user_id: str | int) -> str:
         """
@@ -192,66 +489,199 @@ CONSTRAINT user_id FOREIGN KEY (user_id) REFERENCES users (id) ON UPDATE CASCADE
         :return: Session state ID
         """
         state = "".join(rand_choice(ascii_letters + digits) for _ in range(16))
-        await self._execute("INSERT INTO oauth (state, user_id) VALUE (%s,%s)", (state, user_id))
+        await self._execute(
+            "INSERT INTO oauth (state, user_id) VALUE (%s,%s)", (state, user_id), name="init_oauth_session"
+        )
         return state
 
+    async def purge_oauth_sessions(self, ttl: int, redeemed_ttl: int, batch_size: int = 500) -> int:
+        """
+        Delete expired oauth sessions in small batches
+        :param ttl: Seconds before an unredeemed session expires
+        :param redeemed_ttl: Seconds to keep redeemed sessions for
+        :param batch_size: Maximum rows deleted per statement
+        :return: Number of sessions deleted
+        """
+        purged = 0
+        for redeemed, max_age in (("IS NULL", ttl), ("IS NOT NULL", redeemed_ttl)):
+            while True:
+                deleted = await self._execute(
+                    f"DELETE FROM oauth WHERE code_hash {redeemed} "
+                    "AND time < CURRENT_TIMESTAMP() - INTERVAL %s SECOND ORDER BY time LIMIT %s;",
+                    (max_age, batch_size),
+                    name="purge_oauth_sessions",
+                )
+                purged += deleted
+                if deleted < batch_size:
+                    break
+                # Let verifications in between batches
+                await asyncio.sleep(0.1)
+        return purged
+
     async def add_user(self, user: discord.Member | discord.User) -> None:
         """Add a discord user to the database"""
         await self._execute(
             "INSERT INTO users (id, discord_tag, first_seen) VALUES (%s, %s, CURRENT_TIMESTAMP()) ON DUPLICATE KEY UPDATE discord_tag = %s;",
             (user.id, user.name, user.name),
+            name="add_user",
         )
 
+    async def add_users(self, users: Iterable[discord.Member | discord.User]) -> int:
+        """
+        Add many discord users to the database with chunked multi-row upserts
+        :param users: Members to add, duplicates are ignored
+        :return: Number of distinct users written
+        """
+        rows = {user.id: user.name for user in users}
+        items = list(rows.items())
+        for start in range(0, len(items), self.batch_size):
+            chunk = items[start : start + self.batch_size]
+            await self._execute(
+                "INSERT INTO users (id, discord_tag, first_seen) VALUES "
+                + ",".join(["(%s, %s, CURRENT_TIMESTAMP())"] * len(chunk))
+                + " ON DUPLICATE KEY UPDATE discord_tag = VALUES(discord_tag);",
+                tuple(value for row in chunk for value in row),
+                name="add_users",
+            )
+        return len(items)
+
     async def get_user(self, user_id: str | int) -> User | None:
         """
         Get the user object for a verified user
         :param user_id: Discord ID of user
         :return: User object or None if user is invalid
         """
+        if (user := self.user_cache.get(int(user_id))) is not None:
+            return user
         user_info = await self._execute(
-            "SELECT email,name,position,ialab_username FROM users WHERE id = %s", (user_id,), response=True
+            "SELECT email,name,position,ialab_username,UNIX_TIMESTAMP(ialab_validated) FROM users WHERE id = %s",
+            (user_id,),
+            response=True,
+            name="get_user",
         )
         if user_info is None:
             return None
-        return self.User(email=user_info[0], name=user_info[1], position=user_info[2], ialab_username=user_info[3])
+        user = self.User(
+            email=user_info[0],
+            name=user_info[1],
+            position=user_info[2],
+            ialab_username=user_info[3],
+            ialab_validated=float(user_info[4]) if user_info[4] is not None else None,
+        )
+        self.user_cache.set(int(user_id), user)
+        return user
 
-    async def update_user(self, uid: str | int, *, email: str, name: str, position: str, username: str) -> None:
-        """Update a user in the DB"""
+    async def get_users(self, user_ids: Iterable[str | int]) -> dict[int, User]:
+        """
+        Get the user objects for many users at once
+        :param user_ids: Discord IDs of users
+        :return: Dict of Discord ID to User object, unknown users are omitted
+        """
+        users = {}
+        missing = []
+        for user_id in {int(user_id) for user_id in user_ids}:
+            if (user := self.user_cache.get(user_id)) is not None:
+                users[user_id] = user
+            else:
+                missing.append(user_id)
+        for start in range(0, len(missing), self.batch_size):
+            chunk = missing[start : start + self.batch_size]
+            rows = await self._fetchall(
+                "SELECT id,email,name,position,ialab_username,UNIX_TIMESTAMP(ialab_validated) FROM users WHERE id IN ("
+                + ",".join(["%s"] * len(chunk))
+                + ")",
+                tuple(chunk),
+                name="get_users",
+            )
+            for row in rows:
+                user = self.User(
+                    email=row[1],
+                    name=row[2],
+                    position=row[3],
+                    ialab_username=row[4],
+                    ialab_validated=float(row[5]) if row[5] is not None else None,
+                )
+                self.user_cache.set(int(row[0]), user)
+                users[int(row[0])] = user
+        return users
+
+    async def update_user(self, uid: str | int, *, email: str, name: str, position: str, username: str = None) -> None:
+        """Update a user in the DB. The discord tag is kept if username is None"""
         # Replacing the id kills the fk to verify thus deleting the pending verifications
         #     "REPLACE INTO discord.users (id, discordTag, email, name, position) VALUES (%s, %s, %s, %s, %s)"
         await self._execute(
-            "UPDATE users SET discord_tag = %s, email = %s, name = %s, position = %s, verify_date = CURRENT_TIMESTAMP() where id = %s;",
+            "UPDATE users SET discord_tag = COALESCE(%s, discord_tag), email = %s, name = %s, position = %s, verify_date = CURRENT_TIMESTAMP() where id = %s;",
             (username, email, name, position, uid),
+            name="update_user",
         )
+        self.user_cache.invalidate(int(uid))
 
     async def update_ialab_username(self, uid: str | int, ialab_username: str):
-        """Set the user's ialab username"""
+        """Set the user's ialab username. The username must already be validated"""
         await self._execute(
-            "UPDATE users SET ialab_username = %s where id = %s;",
+            "UPDATE users SET ialab_username = %s, ialab_validated = CURRENT_TIMESTAMP() where id = %s;",
             (ialab_username, uid),
+            name="update_ialab_username",
+        )
+        self.user_cache.invalidate(int(uid))
+
+    async def mark_ialab_validated(self, uid: str | int):
+        """Record that the user's ialab username was just validated"""
+        await self._execute(
+            "UPDATE users SET ialab_validated = CURRENT_TIMESTAMP() where id = %s;", (uid,), name="mark_ialab_validated"
         )
+        self.user_cache.invalidate(int(uid))
 
-    async def update_session(self, state: str, code: str, access_token: str) -> None:
-        """Update an oauth session with the code and access token."""
+    async def update_session(self, state: str, user_id: str | int, code: str, claims: dict) -> None:
+        """Update an oauth session with the code hash and token claims, creating it for signed states."""
         await self._execute(
-            "UPDATE oauth SET access_token = %s, authorization_code = %s WHERE state = %s;", (access_token, code, state)
+            "INSERT INTO oauth (state, user_id, code_hash, claims) VALUES (%s, %s, %s, %s) "
+            "ON DUPLICATE KEY UPDATE code_hash = VALUES(code_hash), claims = VALUES(claims);",
+            (state, user_id, hash_code(code), json.dumps(claims)),
+            name="update_session",
         )
 
     async def get_state_user_id(self, state: str) -> str | None:
         """Get the user ID responsible for an oauth state"""
-        row = await self._execute("SELECT user_id FROM oauth WHERE state = %s;", (state,), response=True)
+        row = await self._execute(
+            "SELECT user_id FROM oauth WHERE state = %s;", (state,), response=True, name="get_state_user_id"
+        )
         if row is None:
             return None
         return row[0]
 
-    async def get_access_token(self, code: str) -> str | None:
-        """Get the access token associated with an authorization code"""
+    async def get_warm_vapps(self) -> list[tuple[str, str, float]]:
+        """Get every pooled vApp as (vApp ID, template ID, unix creation time)"""
+        rows = await self._fetchall(
+            "SELECT vapp_id,template_id,UNIX_TIMESTAMP(created) FROM warm_pool;", (), name="get_warm_vapps"
+        )
+        return [(row[0], row[1], float(row[2])) for row in rows]
+
+    async def add_warm_vapp(self, vapp_id: str, template_id: str) -> None:
+        """Add a pre-deployed vApp to the pool"""
+        await self._execute(
+            "INSERT INTO warm_pool (vapp_id, template_id) VALUES (%s, %s);",
+            (vapp_id, template_id),
+            name="add_warm_vapp",
+        )
+
+    async def remove_warm_vapp(self, vapp_id: str) -> bool:
+        """
+        Take a vApp out of the pool
+        :return: False if the vApp was already taken
+        """
+        return (
+            await self._execute("DELETE FROM warm_pool WHERE vapp_id = %s;", (vapp_id,), name="remove_warm_vapp") == 1
+        )
+
+    async def get_claims(self, code: str) -> dict | None:
+        """Get the token claims associated with an authorization code"""
         row = await self._execute(
-            "SELECT access_token FROM oauth WHERE authorization_code = %s;", (code,), response=True
+            "SELECT claims FROM oauth WHERE code_hash = %s;", (hash_code(code),), response=True, name="get_claims"
         )
-        if row is None:
+        if row is None or row[0] is None:
             return None
-        return row[0]
+        return json.loads(row[0])
 
 
 class AzureOauth:
@@ -259,11 +689,85 @@ class AzureOauth:
 
     BASE_URL = "https://login.microsoftonline.com/common/oauth2/v2.0/"
 
-    def __init__(self, *, client_id: str, redirect_uri: str, scopes: list, secret: str):
+    def __init__(
+        self,
+        *,
+        client_id: str,
+        redirect_uri: str,
+        scopes: list,
+        secret: str,
+        state_secret: str = None,
+        state_ttl: int = 3600,
+        timeout: float = 10,
+    ):
         self.client_id = client_id
         self.scopes = scopes
         self.redirect_uri = redirect_uri
         self.secret = secret
+        self.state_secret = state_secret
+        self.state_ttl = state_ttl
+        self.policy = OutboundPolicy("Microsoft login", default_timeout=timeout)
+        self._session: aiohttp.ClientSession | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Shared keep-alive session, created on first use inside the event loop"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def close(self) -> None:
+        """Close the shared session"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @classmethod
+    def from_creds(cls, creds: dict) -> "AzureOauth":
+        """Create an oauth handler from a creds dict"""
+        return cls(
+            client_id=creds["oauth"]["client_id"],
+            secret=creds["oauth"]["client_secret"],
+            scopes=["openid+User.Read"],
+            redirect_uri="https://auth.defsec.club/azure/auth",
+            state_secret=value_or_none(creds["oauth"].get("state_secret")),
+            state_ttl=int(creds["oauth"].get("session_ttl", 3600)),
+            timeout=float(creds["oauth"].get("timeout", 10)),
+        )
+
+    @property
+    def stateless(self) -> bool:
+        """Whether states are signed tokens instead of DB sessions"""
+        return self.state_secret is not None
+
+    def _state_signature(self, payload: str) -> str:
+        digest = hmac.new(self.state_secret.encode(), payload.encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:12]).decode()
+
+    def sign_state(self, user_id: str | int) -> str:
+        """
+        Create a signed, time limited oauth state for a user
+        :param user_id: Discord user ID
+        :return: State in the form <user id>.<hex expiry>.<signature>
+        """
+        payload = f"{user_id}.{int(time.time()) + self.state_ttl:x}"
+        return f"{payload}.{self._state_signature(payload)}"
+
+    def verify_state(self, state: str) -> int | None:
+        """
+        Check a signed oauth state
+        :param state: State created by sign_state
+        :return: Discord user ID or None if the state is forged or expired
+        """
+        try:
+            user_id, expiry, signature = state.split(".")
+            if not hmac.compare_digest(signature, self._state_signature(f"{user_id}.{expiry}")):
+                return None
+            if int(expiry, 16) < time.time():
+                return None
+            return int(user_id)
+        except ValueError:
+            return None
 
     def request(self, state: str) -> str:
         """Build an oauth request url"""
@@ -280,25 +784,35 @@ class AzureOauth:
         )
 
     async def get_access_token(self, code: str) -> str | None:
-        """Use an authorization code to redeem an access token"""
-        auth_response = requests.post(
-            f"{self.BASE_URL}token",
-            {
-                "grant_type": "authorization_code",
-                "code": code,
-                "redirect_uri": self.redirect_uri,
-                "client_id": self.client_id,
-                "client_secret": self.secret,
-            },
-        )
+        """
+        Use an authorization code to redeem an access token
+        :raises DependencyUnavailable: If Microsoft login is failing
+        """
+
+        async def redeem() -> tuple[int, str]:
+            async with self.session.post(
+                f"{self.BASE_URL}token",
+                data={
+                    "grant_type": "authorization_code",
+                    "code": code,
+                    "redirect_uri": self.redirect_uri,
+                    "client_id": self.client_id,
+                    "client_secret": self.secret,
+                },
+            ) as resp:
+                return resp.status, await resp.text()
+
+        # Codes can only be redeemed once so this is never retried
+        with OAUTH_LATENCY.time():
+            status, text = await self.policy.call("token", redeem, idempotent=False, failed=lambda r: r[0] >= 500)
         try:
-            resp_json = auth_response.json()
-        except requests.exceptions.JSONDecodeError:
+            resp_json = json.loads(text)
+        except ValueError:
             logger.warning("Non json auth response")
-            logger.warning(auth_response.text)
+            logger.warning(text)
             return None
 
-        if auth_response.status_code != 200:
+        if status != 200:
             # 54005 = Already redeemed
             if 54005 in resp_json.get("error_codes", []):
                 return None
@@ -307,7 +821,7 @@ class AzureOauth:
                 logger.warning(json.dumps(resp_json, indent=2))
             except Exception as e:
                 logger.warning(f"Error processing oauth response: {e}")
-                logger.warning(auth_response.text)
+                logger.warning(text)
             return None
 
         return resp_json["access_token"]
@@ -317,3 +831,45 @@ def get_vapp_url_from_id(vapp_id: str) -> str:
     if vapp_id.startswith("vapp-"):
         vapp_id = vapp_id[5:]
     return f"https://vcloud.ialab.dsu.edu/tenant/DefSec/vdcs/15a9a5ed-d859-4039-b1e7-55476cfe58ef/vapp/vapp-{vapp_id}/vcd-vapp-vms"
+
+
+@dataclasses.dataclass
+class Verification:
+    """A redeemed oauth response"""
+
+    user_id: int
+    email: str
+    name: str
+    position: str
+
+
+async def redeem_oauth(dbc: DBC, oauth: AzureOauth, state: str, code: str) -> Verification | str:
+    """
+    Redeem an oauth response and save the user's new details
+    :param state: oauth state code
+    :param code: oauth authorization code
+    :return: The verification or an error message for the user
+    """
+    if oauth.stateless and "." in state:
+        user_id = oauth.verify_state(state)
+    else:
+        user_id = await dbc.get_state_user_id(state)
+    if user_id is None:
+        VERIFICATIONS.inc(result="invalid")
+        return "Invalid or expired code 🙁"
+    if (access_token := await oauth.get_access_token(code)) is not None:
+        user_info = get_token_claims(access_token)
+    else:
+        user_info = await dbc.get_claims(code)
+    if user_info is None:
+        VERIFICATIONS.inc(result="invalid")
+        return "Invalid or expired code 🙁"
+    email = user_info["unique_name"]
+    last_name, first_name = user_info["family_name"], user_info["given_name"]
+    position = get_position(email)
+    name = f"{first_name} {last_name}"
+
+    await dbc.update_session(state, user_id, code=code, claims=user_info)
+    await dbc.update_user(user_id, email=email, name=name, position=position)
+    VERIFICATIONS.inc(result="verified")
+    return Verification(user_id=int(user_id), email=email, name=name, position=position)
@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+# @Name: webserver.py
+# @Project: DSUAuthBot/
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import functools
+import gzip
+import ipaddress
+import logging
+import multiprocessing
+import time
+from re import compile as re_compile
+from typing import Awaitable, Callable
+
+from metrics import REGISTRY, VERIFICATIONS, VERIFY_LATENCY
+from outbound import DependencyUnavailable
+from util import AzureOauth, DBC, Verification, redeem_oauth
+
+logger = logging.getLogger("authbot")
+
+
+async def start_webserver(server) -> None:
+    """Start serving the webserver. Infinitely blocking"""
+    async with server:
+        await server.serve_forever()
+
+
+async def start_metrics_server(port: int) -> None:
+    """Serve only /metrics on a local port. Infinitely blocking"""
+    server = await asyncio.get_running_loop().create_server(lambda: RedirectReceiver(None), "127.0.0.1", port)
+    logger.info(f"Metrics listening on 127.0.0.1:{port}")
+    await start_webserver(server)
+
+
+def run_worker(creds: dict, results: multiprocessing.Queue, index: int) -> None:
+    """
+    Entry point of a webserver worker process.
+    Workers redeem oauth responses themselves and pass verified users to the bot through results.
+    Each worker has its own metrics, served on metrics_port + 1 + index when metrics_port is set
+    """
+    logging.basicConfig(filename="run.log")
+    logger.setLevel(logging.INFO)
+    asyncio.run(_serve_worker(creds, results, index))
+
+
+async def _serve_worker(creds: dict, results: multiprocessing.Queue, index: int) -> None:
+    dbc = DBC.from_creds(creds)
+    await dbc.connect()
+    oauth = AzureOauth.from_creds(creds)
+    admission = AdmissionController(**creds.get("webserver_admission", {}))
+
+    async def verify(state: str, code: str) -> str:
+        result = await redeem_oauth(dbc, oauth, state, code)
+        if isinstance(result, Verification):
+            results.put(result)
+            return "Verified 👍"
+        return result
+
+    # Scrapes of the shared port would land on a random worker so metrics are only served on the worker's own port
+    server = await asyncio.get_running_loop().create_server(
+        lambda: RedirectReceiver(
+            verify, compress=bool(creds.get("webserver_compress", False)), admission=admission, metrics=False
+        ),
+        "127.0.0.1",
+        int(creds["webserver_port"]),
+        reuse_port=True,
+    )
+    name = multiprocessing.current_process().name
+    logger.info(f"Webserver worker {name} listening on 127.0.0.1:{creds['webserver_port']}")
+    if metrics_port := int(creds.get("metrics_port", 0)):
+        asyncio.create_task(start_metrics_server(metrics_port + 1 + index))
+    try:
+        await start_webserver(server)
+    finally:
+        await oauth.close()
+        await dbc.close()
+
+
+class HttpError(Exception):
+    """Malformed or unsupported request"""
+
+    def __init__(self, status: str):
+        super().__init__(status)
+        self.status = status
+
+
+@dataclasses.dataclass
+class HttpRequest:
+    """A parsed HTTP/1.x request"""
+
+    method: str
+    target: str
+    version: str
+    headers: dict[str, str]
+    body: bytes = b""
+
+    @property
+    def request_line(self) -> str:
+        return f"{self.method} {self.target} {self.version}"
+
+    @property
+    def keep_alive(self) -> bool:
+        """Whether the client wants the connection kept open after this request"""
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return "keep-alive" in connection
+        return "close" not in connection
+
+
+class HttpRequestParser:
+    """Incremental HTTP/1.x request parser. Data can arrive in any sized chunks and requests may be pipelined"""
+
+    def __init__(self, *, max_header_size: int = 8192, max_body_size: int = 8192):
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self._buffer = bytearray()
+        self._request: HttpRequest | None = None
+        self._body_size = 0
+
+    @property
+    def partial(self) -> bool:
+        """Whether part of a request has been received"""
+        return self._request is not None or bool(self._buffer)
+
+    def feed(self, data: bytes) -> list[HttpRequest]:
+        """
+        Add received data
+        :return: Every request completed by the data
+        :raises HttpError: If the request is malformed or too large
+        """
+        self._buffer += data
+        requests = []
+        while True:
+            if self._request is None:
+                # Empty lines between requests are allowed
+                while self._buffer.startswith(b"\r\n"):
+                    del self._buffer[:2]
+                end = self._buffer.find(b"\r\n\r\n")
+                if end == -1 or end > self.max_header_size:
+                    if len(self._buffer) > self.max_header_size:
+                        raise HttpError("431 Request Header Fields Too Large")
+                    return requests
+                head = bytes(self._buffer[:end]).decode("latin-1")
+                del self._buffer[: end + 4]
+                self._request = self._parse_head(head)
+            if len(self._buffer) < self._body_size:
+                return requests
+            self._request.body = bytes(self._buffer[: self._body_size])
+            del self._buffer[: self._body_size]
+            requests.append(self._request)
+            self._request = None
+
+    def _parse_head(self, head: str) -> HttpRequest:
+        request_line, *header_lines = head.split("\r\n")
+        try:
+            method, target, version = request_line.split(" ")
+        except ValueError:
+            raise HttpError("400 Bad Request")
+        if version not in ("HTTP/1.0", "HTTP/1.1"):
+            raise HttpError("505 HTTP Version Not Supported")
+        headers = {}
+        for line in header_lines:
+            name, colon, value = line.partition(":")
+            if not colon or not name or name != name.strip():
+                raise HttpError("400 Bad Request")
+            name = name.lower()
+            headers[name] = f"{headers[name]}, {value.strip()}" if name in headers else value.strip()
+        if "transfer-encoding" in headers:
+            raise HttpError("501 Not Implemented")
+        try:
+            self._body_size = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HttpError("400 Bad Request")
+        if not 0 <= self._body_size <= self.max_body_size:
+            raise HttpError("413 Content Too Large")
+        return HttpRequest(method=method, target=target, version=version, headers=headers)
+
+
+class Rejected(Exception):
+    """Request refused by admission control"""
+
+    def __init__(self, status: str, message: str):
+        super().__init__(status)
+        self.status = status
+        self.message = message
+
+
+class TokenBucket:
+    """Allows rate requests per second with bursts of up to burst requests"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        """Spend a token if one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class AdmissionController:
+    """Caps concurrent verifications, bounds the wait for a slot and rate limits each client"""
+
+    TRUSTED_PROXIES = ("127.0.0.1", "::1")
+
+    def __init__(
+        self,
+        *,
+        max_concurrent: int = 8,
+        max_waiting: int = 64,
+        rate: float = 2,
+        burst: float = 20,
+        max_clients: int = 10000,
+    ):
+        """
+        :param max_concurrent: Verifications allowed to run at once
+        :param max_waiting: Verifications allowed to wait for a slot before new ones get a 503
+        :param rate: Requests per second allowed for each client
+        :param burst: Requests a client may make at once
+        :param max_clients: Number of client buckets remembered
+        """
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.active = 0
+        self.waiting = 0
+        self.stats = {"admitted": 0, "rate_limited": 0, "queue_full": 0}
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._buckets: collections.OrderedDict[str, TokenBucket] = collections.OrderedDict()
+
+    def client_address(self, peer: str, request: HttpRequest) -> str:
+        """Address of the client, taken from X-Forwarded-For when the request came through the local proxy"""
+        if peer in self.TRUSTED_PROXIES and (forwarded := request.headers.get("x-forwarded-for")):
+            # The proxy appends the address it saw to the end
+            return forwarded.split(",")[-1].strip()
+        return peer
+
+    def check_rate(self, client: str) -> None:
+        """
+        Take a token from the client's bucket
+        :raises Rejected: If the client is over its rate
+        """
+        if (bucket := self._buckets.get(client)) is None:
+            bucket = self._buckets[client] = TokenBucket(self.rate, self.burst)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(client)
+        if not bucket.take():
+            self.stats["rate_limited"] += 1
+            raise Rejected("429 Too Many Requests", "Slow down 🐢")
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """
+        Hold a verification slot
+        :raises Rejected: If too many verifications are already waiting
+        """
+        if self._slots.locked() and self.waiting >= self.max_waiting:
+            self.stats["queue_full"] += 1
+            raise Rejected("503 Service Unavailable", "Too many verifications right now, try again in a minute 😢")
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        self.stats["admitted"] += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._slots.release()
+
+
+PAGE_PREFIX = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <title>DSU Verification</title>
+    <style>
+        body {
+            background: #004165;
+        }
+
+        .center {
+            position: absolute;
+            left: 50%;
+            top: 30%;
+            transform: translate(-50%, -50%);
+            text-align: center;
+            color: #ffffff;
+        }
+
+        .center > * {
+            margin: 0;
+        }
+
+        #main {
+            background: #ADAFAF;
+            border-radius: 10px;
+            padding: 15px;
+        }
+    </style>
+</head>
+<body>
+<div class="center" id="main"><h1>""".encode("UTF-8")
+PAGE_SUFFIX = """</h1></div></body></html>""".encode("UTF-8")
+
+
+@functools.lru_cache(maxsize=256)
+def render_response(message: str, status_code: str, keep_alive: bool, compress: bool) -> tuple[bytes, ...]:
+    """
+    Render a response once as byte buffers for transport.writelines
+    :param compress: gzip the page, only worth it for clients that accept it
+    """
+    body = (PAGE_PREFIX, message.encode("UTF-8"), PAGE_SUFFIX)
+    if compress:
+        body = (gzip.compress(b"".join(body)),)
+    http_response = f"HTTP/1.1 {status_code}\r\n"
+    http_response += "Server: DefSecAuthBot/2.0 Python/3\r\n"
+    http_response += "Content-Type: text/html; charset=utf-8\r\n"
+    http_response += "Root-Password: Password1!\r\n"
+    http_response += f"Content-Length: {sum(len(part) for part in body)}\r\n"
+    http_response += f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+    if compress:
+        http_response += "Content-Encoding: gzip\r\n"
+        http_response += "Vary: Accept-Encoding\r\n"
+    http_response += "\r\n"
+    return (http_response.encode("UTF-8"), *body)
+
+
+class RedirectReceiver(asyncio.Protocol):
+    """Very simple webserver to receive oauth"""
+
+    # noinspection RegExpAnonymousGroup
+    # The state runs up to the next parameter so a trailing state keeps its last character
+    REQUEST_LINE_RE = re_compile(
+        r"^GET /.*\?code=([a-zA-Z0-9._-]+)&state=([a-zA-Z0-9._-]{16,64})(?:&\S*)? HTTP/\d\.\d$"
+    )
+
+    def __init__(
+        self,
+        verify: Callable[[str, str], Awaitable[str]] | None,
+        *,
+        read_timeout: float = 10,
+        keep_alive_timeout: float = 30,
+        max_header_size: int = 8192,
+        max_pipelined: int = 8,
+        compress: bool = False,
+        admission: AdmissionController = None,
+        metrics: bool = True,
+    ):
+        """
+        :param verify: Coroutine function taking the oauth state and code and returning the message for the user.
+            None to only serve metrics
+        :param read_timeout: Seconds allowed to receive a whole request, counted from its first byte
+        :param keep_alive_timeout: Seconds an idle keep-alive connection stays open
+        :param max_pipelined: Reading pauses while this many requests are waiting
+        :param compress: gzip responses for clients that accept it
+        :param admission: Admission control shared by every connection
+        :param metrics: Serve /metrics to local clients
+        """
+        self.verify = verify
+        self.metrics = metrics or verify is None
+        self.read_timeout = read_timeout
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_pipelined = max_pipelined
+        self.compress = compress
+        self.admission = admission if admission is not None else AdmissionController()
+        self.parser = HttpRequestParser(max_header_size=max_header_size)
+        self.transport: asyncio.Transport | None = None
+        self._requests: collections.deque[HttpRequest] = collections.deque()
+        self._task: asyncio.Task | None = None
+        self._timer: asyncio.TimerHandle | None = None
+        self._deadline: float | None = None
+        self._paused = False
+
+    def connection_made(self, transport) -> None:
+        """New connection"""
+        self.transport = transport
+        self._reset_timer()
+
+    def connection_lost(self, exc) -> None:
+        """Connection closed. Running verifications are left to finish"""
+        if self._timer is not None:
+            self._timer.cancel()
+        self._requests.clear()
+
+    def data_received(self, data) -> None:
+        """Data received on the socket"""
+        try:
+            requests = self.parser.feed(data)
+        except HttpError as e:
+            self._requests.clear()
+            self.send_response("Invalid request<br>Pls no hak me 😢", e.status, keep_alive=False)
+            return
+        self._requests.extend(requests)
+        if requests:
+            # Any partial data left over starts the next request's deadline
+            self._deadline = None
+        if len(self._requests) >= self.max_pipelined and not self._paused:
+            self._paused = True
+            self.transport.pause_reading()
+        if self._requests and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._process_requests())
+        self._reset_timer()
+
+    async def _process_requests(self) -> None:
+        """Answer queued requests in order"""
+        while self._requests and not self.transport.is_closing():
+            request = self._requests.popleft()
+            if self._paused and len(self._requests) < self.max_pipelined:
+                self._paused = False
+                self.transport.resume_reading()
+            await self.handle_request(request)
+        self._reset_timer()
+
+    async def handle_request(self, request: HttpRequest) -> None:
+        """Verify the oauth response in a request"""
+        keep_alive = request.keep_alive
+        compress = "gzip" in request.headers.get("accept-encoding", "")
+        peer = self.transport.get_extra_info("peername")[0]
+        if self.metrics and request.method == "GET" and request.target == "/metrics" and self.is_local(peer, request):
+            self.send_metrics(keep_alive=keep_alive)
+            return
+        if self.verify is None:
+            self.send_response("Not found 🤷", "404 Not Found", keep_alive=keep_alive, compress=compress)
+            return
+
+        client = self.admission.client_address(peer, request)
+        try:
+            self.admission.check_rate(client)
+        except Rejected as e:
+            VERIFICATIONS.inc(result="rejected")
+            self.send_response(e.message, e.status, keep_alive=keep_alive, compress=compress)
+            return
+
+        matches = RedirectReceiver.REQUEST_LINE_RE.fullmatch(request.request_line)
+        if matches is None:
+            self.send_response(
+                "Invalid request<br>Pls no hak me 😢", "400 no 👎", keep_alive=keep_alive, compress=compress
+            )
+            return
+
+        authorization_code = matches[1]
+        state = matches[2]
+        logger.info(f"Auth: {state=} {authorization_code[:10]} from {client}")
+        try:
+            async with self.admission.slot():
+                with VERIFY_LATENCY.time():
+                    message = await self.verify(state, authorization_code)
+            self.send_response(message, keep_alive=keep_alive, compress=compress)
+        except Rejected as e:
+            VERIFICATIONS.inc(result="rejected")
+            self.send_response(e.message, e.status, keep_alive=keep_alive, compress=compress)
+        except DependencyUnavailable as e:
+            VERIFICATIONS.inc(result="unavailable")
+            self.send_response(e.message, "503 Service Unavailable", keep_alive=keep_alive, compress=compress)
+        except Exception as e:
+            VERIFICATIONS.inc(result="error")
+            logger.warning(f"Uncaught exception: {e} in verify")
+            self.send_response("Invalid request 😢", "500 Oopsy Woopsy", keep_alive=keep_alive, compress=compress)
+
+    def _reset_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        if self.transport is None or self.transport.is_closing():
+            return
+        loop = asyncio.get_running_loop()
+        if not self.parser.partial:
+            self._deadline = None
+            self._timer = loop.call_later(self.keep_alive_timeout, self._timed_out)
+            return
+        # Not extended by later chunks so trickling a request in byte by byte cannot hold the connection open
+        if self._deadline is None:
+            self._deadline = loop.time() + self.read_timeout
+        self._timer = loop.call_at(self._deadline, self._timed_out)
+
+    def _timed_out(self) -> None:
+        if self._task is not None and not self._task.done():
+            # Still answering, the timer restarts once done
+            return
+        if self.parser.partial:
+            self.send_response("Request timed out 😴", "408 Request Timeout", keep_alive=False)
+        else:
+            self.transport.close()
+
+    @staticmethod
+    def is_local(peer: str, request: HttpRequest) -> bool:
+        """Whether a request came straight from this machine rather than through the reverse proxy"""
+        try:
+            loopback = ipaddress.ip_address(peer).is_loopback
+        except ValueError:
+            return False
+        return loopback and "x-forwarded-for" not in request.headers
+
+    def send_metrics(self, keep_alive: bool = False) -> None:
+        """Send this process's metrics in the Prometheus text format"""
+        if self.transport.is_closing():
+            return
+        body = REGISTRY.render().encode("UTF-8")
+        http_response = "HTTP/1.1 200 OK\r\n"
+        http_response += "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+        http_response += f"Content-Length: {len(body)}\r\n"
+        http_response += f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        http_response += "\r\n"
+        self.transport.writelines((http_response.encode("UTF-8"), body))
+        if not keep_alive:
+            self.transport.close()
+
+    def send_response(self, message, status_code="200 OK", keep_alive: bool = False, compress: bool = False):
+        """Send an HTML formatted response"""
+        if self.transport.is_closing():
+            return
+        # noinspection PyUnresolvedReferences
+        self.transport.writelines(render_response(message, status_code, keep_alive, compress and self.compress))
+        if not keep_alive:
+            self.transport.close()